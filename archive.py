@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+archive.py
+============
+
+Stamping the headers of the files within a source archive without
+extracting it::
+
+    licensehd.py --archive opticks-0.1.tar.gz --archive-out stamped.tar.gz
+    licensehd.py --archive opticks-0.1.zip --archive-out stamped.zip
+    licensehd.py --archive opticks-0.1.tar.gz --check                         # nothing written
+    cat opticks-0.1.tar | licensehd.py --archive - --archive-out - > stamped.tar
+
+The archive is read and the output written in a single pass. Members with
+names known to FileTypes, outside PRUNE_DIRS and not matching any --exclude,
+go through the same LicenseHD logic as files on disk. This reads only the
+header window and copies the rest of the member in chunks, so no member is
+ever held entirely in memory. All other members, including directories and links,
+are copied through unchanged. The metadata of every member is kept,
+including mtime, mode and ownership. A rewritten member differs only in
+its content and size.
+
+A tar is read as a stream with the "r|*" mode of tarfile, so gzip, bzip2
+and xz compression are handled and "-" can be used for stdin and stdout.
+The compression of the output follows its suffix, .tar.gz .tgz .tar.bz2
+.tar.xz, otherwise plain tar. A zip is read member by member following its
+central directory, and each member is recompressed with its original method.
+Writing zip members as streams requires python 3.6.
+
+When the output goes to stdout with "--archive-out -" the per member
+reports of "--report jsonl" are refused, as they would corrupt the archive.
+
+Scripts without an extension are not recognized from their "#!" line within
+archives. The output is written to a temporary file renamed into place once
+complete.
+
+"""
+import os, sys, copy, logging
+log = logging.getLogger(__name__)
+
+from licensehd import LicenseHD, FT, PRUNE_DIRS, TMP_SUFFIX, replace, is_excluded, error_result, summary, CHECK_FAILS, CHECK_FMT, REPR_FMT
+
+
+TAR_MODES = [(".tar.gz", "gz"), (".tgz", "gz"), (".tar.bz2", "bz2"), (".tbz2", "bz2"), (".tar.xz", "xz"), (".txz", "xz")]
+
+
+class HeadBuffer(object):
+    """
+    Binary file object over a forward only stream, such as a member of a
+    streamed archive, for use as the LicenseHD text. While keep is True the
+    bytes read are kept, so seeks back within the header window work.
+    After that reads continue from the stream, beyond the kept bytes.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.kept = b""
+        self.pos = 0
+        self.keep = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False    # the stream belongs to the archive, not closed here
+
+    def seek(self, pos):
+        assert pos <= len(self.kept), "cannot seek beyond the kept %d bytes of a stream : %d " % (len(self.kept), pos)
+        self.pos = pos
+
+    def read(self, n=-1):
+        data = b""
+        if self.pos < len(self.kept):
+            data = self.kept[self.pos:] if n < 0 else self.kept[self.pos:self.pos+n]
+            self.pos += len(data)
+            if len(data) == n: return data
+            if n > 0:
+                n -= len(data)
+            pass
+        pass
+        more = self.f.read(n)   # continuing from the stream, so reads are only short at the end
+        if self.keep:
+            self.kept += more
+        pass
+        self.pos += len(more)
+        return data + more
+
+    def readline(self, limit=-1):
+        line = b""
+        if self.pos < len(self.kept):
+            end = len(self.kept) if limit < 0 else min(len(self.kept), self.pos + limit)
+            i = self.kept.find(b"\n", self.pos, end)
+            end = end if i < 0 else i + 1
+            line = self.kept[self.pos:end]
+            self.pos = end
+            if line.endswith(b"\n") or len(line) == limit: return line
+        pass
+        more = self.f.readline(limit if limit < 0 else limit - len(line))
+        if self.keep:
+            self.kept += more
+        pass
+        self.pos += len(more)
+        return line + more
+
+    def release(self, pos=0):
+        """
+        stop keeping bytes and position for the reading of the rest of the stream
+        """
+        self.keep = False
+        self.seek(pos)
+
+
+class Rewritten(object):
+    """
+    File object reading a rewritten member: the new head followed by the
+    source beyond the original header. Reads are only short at the end,
+    as tarfile requires.
+    """
+    def __init__(self, lh, src, size):
+        """
+        :param lh: LicenseHD of the member with src as its text
+        :param src: HeadBuffer of the member
+        :param size: of the original member
+        """
+        self.head = lh.head_bytes()
+        self.src = src
+        self.size = len(self.head) + size - lh.offset
+        src.release(lh.offset)
+
+    def read(self, n=-1):
+        parts = []
+        while n != 0:
+            if len(self.head) > 0:
+                data = self.head if n < 0 else self.head[:n]
+                self.head = self.head[len(data):]
+            else:
+                data = self.src.read(n)
+                if not data: break
+            pass
+            parts.append(data)
+            if n > 0:
+                n -= len(data)
+            pass
+        pass
+        return b"".join(parts)
+
+
+def process_member(name, src, size, args):
+    """
+    Counterpart of process_path for a member of an archive
+
+    :param name: of the member
+    :param src: binary file object reading the member, forward only
+    :param size: of the member in bytes
+    :return (r, f, size): result, or None for members that are not candidates, with
+             a file object reading the output member of the size
+    """
+    base = os.path.basename(name)
+    ftype = FT.ftype_of(base)
+    if ftype is None or any(part in PRUNE_DIRS for part in name.split("/")[:-1]) or (args.exclude and is_excluded(name, base, False, args.exclude, [])):
+        return None, src, size
+    pass
+    buf = HeadBuffer(src)
+    try:
+        lh = LicenseHD(name, args, text=buf, ftype=ftype)
+        r = lh.result()
+        if lh.binary is not None or lh.has_other_license:
+            r["action"] = "skipped"
+        elif lh.uptodate:
+            r["action"] = "unchanged"
+        elif args.check:
+            r["action"] = "stale" if lh.has_license else "missing"
+        elif not lh.check_counts():
+            r["action"] = "failed"
+        else:
+            r["action"] = "rewritten"
+            r["written"] = True
+            f = Rewritten(lh, buf, size)
+            return r, f, f.size
+        pass
+    except (UnicodeError, AssertionError) as err:
+        r = error_result(name, err)    # copied through unchanged
+    pass
+    buf.release()
+    return r, buf, size
+
+
+def tar_mode(path):
+    """
+    :return mode: for writing a tar stream with the compression of the path suffix
+    """
+    for suffix, comp in TAR_MODES:
+        if path.endswith(suffix):
+            return "w|" + comp
+        pass
+    pass
+    return "w|"
+
+def iter_tar(inp, out, args, mode="w|"):
+    """
+    :param inp: path of the archive or "-" for stdin
+    :param out: path of the output archive, "-" for stdout or None to only read
+    :param mode: for writing the output, see tar_mode
+    :return: generator of the results of the candidate members
+    """
+    import tarfile
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    tin = tarfile.open(inp if inp != "-" else None, "r|*", fileobj=stdin if inp == "-" else None)
+    tout = None
+    if out is not None:
+        tout = tarfile.open(out if out != "-" else None, mode, fileobj=stdout if out == "-" else None)
+    pass
+    try:
+        for member in tin:
+            if member.isfile():
+                r, f, size = process_member(member.name, tin.extractfile(member), member.size, args)
+            else:
+                r, f, size = None, None, None
+            pass
+            if tout is not None:
+                if f is not None and size != member.size:
+                    member = copy.copy(member)
+                    member.size = size
+                    member.pax_headers = dict((k, v) for k, v in member.pax_headers.items() if k != "size")
+                pass
+                tout.addfile(member, f)
+            pass
+            if r is not None:
+                yield r
+            pass
+        pass
+    finally:
+        tin.close()
+        if tout is not None:
+            tout.close()
+        pass
+    pass
+
+def iter_zip(inp, out, args):
+    """
+    :param inp: path of the zip
+    :param out: path of the output zip, "-" for stdout or None to only read
+    :return: generator of the results of the candidate members
+    """
+    import zipfile, shutil
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    zin = zipfile.ZipFile(inp, "r")
+    zout = None
+    if out is not None:
+        zout = zipfile.ZipFile(stdout if out == "-" else out, "w", allowZip64=True)
+    pass
+    try:
+        for info in zin.infolist():
+            if info.filename.endswith("/"):
+                if zout is not None:
+                    zout.writestr(copy.copy(info), b"")
+                pass
+                continue
+            pass
+            with zin.open(info) as src:
+                r, f, size = process_member(info.filename, src, info.file_size, args)
+                if zout is not None:
+                    oinfo = copy.copy(info)
+                    oinfo.file_size = size
+                    with zout.open(oinfo, "w", force_zip64=size >= zipfile.ZIP64_LIMIT) as fw:
+                        shutil.copyfileobj(f, fw, LicenseHD.bufsize)
+                    pass
+                pass
+            pass
+            if r is not None:
+                yield r
+            pass
+        pass
+    finally:
+        zin.close()
+        if zout is not None:
+            zout.close()
+        pass
+    pass
+
+
+def archive_filter(args):
+    """
+    Process the members of args.archive writing args.archive_out, with --check only read
+
+    :return rc: non-zero for check failures or any member that failed
+    """
+    import json, tarfile, zipfile
+    inp = args.archive
+    out = None if args.check else args.archive_out
+    is_zip = inp != "-" and zipfile.is_zipfile(inp)
+    if is_zip and sys.version_info < (3, 6):
+        log.fatal("zip archives require python 3.6 or later")
+        return 2
+    pass
+    tmp = None if out in (None, "-") else out + TMP_SUFFIX
+    counts, msgs, failed = {}, {}, []
+    failures, errors = 0, 0
+    ok = False
+    try:
+        results = iter_zip(inp, tmp or out, args) if is_zip else iter_tar(inp, tmp or out, args, tar_mode(out or ""))
+        for r in results:
+            log.debug(REPR_FMT % r)
+            counts[r["action"]] = counts.get(r["action"], 0) + 1
+            msgs[r["msg"]] = msgs.get(r["msg"], 0) + 1
+            if r["action"] == "failed" or r["action"] in CHECK_FAILS:
+                failed.append(dict(path=r["path"], action=r["action"], msg=r["msg"], error=r.get("error")))
+            pass
+            if "error" in r:
+                errors += 1
+            pass
+            if args.report == "jsonl":
+                print(json.dumps(r))
+            elif args.report == "table" and r["action"] in CHECK_FAILS:
+                print(CHECK_FMT % r)
+            pass
+            if r["action"] in CHECK_FAILS:
+                failures += 1
+            pass
+        pass
+        ok = True
+    except (tarfile.TarError, zipfile.BadZipfile, EOFError) as err:
+        log.fatal("failed to read archive %s : %s: %s " % (inp, type(err).__name__, err))
+        return 2
+    except (IOError, OSError) as err:
+        log.fatal("failed to process archive %s : %s: %s " % (inp, type(err).__name__, err))
+        return 2
+    finally:
+        if tmp is not None:
+            if ok:
+                replace(tmp, out)
+            elif os.path.exists(tmp):
+                os.remove(tmp)
+            pass
+        pass
+    pass
+    log.info("%s %s" % (inp, summary(counts)))
+    if errors > 0:
+        log.warning("%d members failed with errors and were copied unchanged " % errors)
+    pass
+    if args.report_json is not None:
+        from shards import make_report, write_report
+        write_report(args.report_json, make_report(None, counts, msgs, failed))
+    pass
+    return 1 if failures > 0 or errors > 0 else 0
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+"""
+bench.py
+==========
+
+Reproducible benchmark of the licensehd.py hot paths over a synthetic tree.
+The tree is generated with a seeded random number generator from:
+
+* number of files and approximate file size
+* mix of file types from FileTypes.typeSettings
+* fractions of files with an existing (current) header, a foreign header, or none
+
+The phases are timed separately:
+
+discover
+    walk with get_paths
+classify
+    LicenseHD construction on every path, as done by --check
+rewrite
+    run over every path, writing headers where missing
+rerun
+    second run over every path, all files now up to date
+
+The cold start cost is measured separately, as the minimum over several
+fresh interpreters of the cumulative "import licensehd" time reported by
+python -X importtime (3.7+), and compared with a budget, the exit code being
+non-zero when the budget is exceeded::
+
+    python bench.py --files 0 --startup-budget-ms 80
+
+Each phase reports files/sec, MB/sec relative to the tree size and the peak
+RSS so far. Results are written as JSON, including the git commit of this
+checkout, so runs can be compared across commits::
+
+    python bench.py --files 5000 --size 8000 --out /tmp/bench_$(git rev-parse --short HEAD).json
+    python bench.py --types c,python --existing 0.5 --foreign 0.1 --jobs 4
+
+"""
+import os, sys, time, json, random, shutil, tempfile, argparse, logging, subprocess, resource
+log = logging.getLogger(__name__)
+
+import licensehd
+from licensehd import FT, LicenseHD, get_paths, run, parse_args
+
+FOREIGN = ["Copyright (c) 1999 Other Corporation. All rights reserved.\n", "\n", "Used with permission.\n"]
+
+
+def peak_rss_mb():
+    """
+    :return: peak resident set size of this process and its waited for children in MB (ru_maxrss is kB on Linux) 
+    """
+    scale = 1024.*1024. if sys.platform == "darwin" else 1024.
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss/scale
+
+def import_time_ms(module="licensehd", runs=5):
+    """
+    :return ms: minimum over runs of the cumulative import time of module in a fresh interpreter, or None 
+    """
+    if sys.version_info < (3, 7): return None
+    here = os.path.dirname(os.path.abspath(__file__))
+    best = None
+    for i in range(runs):
+        p = subprocess.Popen([sys.executable, "-X", "importtime", "-c", "import %s" % module], cwd=here, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
+        _, err = p.communicate()
+        for line in err.decode("utf-8", "replace").splitlines():
+            fields = [f.strip() for f in line.split("|")]
+            if len(fields) == 3 and fields[2] == module:
+                us = int(fields[1])
+                best = us if best is None else min(best, us)
+            pass
+        pass
+    pass
+    return None if best is None else best/1000.
+
+def git_commit():
+    try:
+        out = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    pass
+    return out.strip().decode("ascii")
+
+
+class Corpus(object):
+    """
+    Synthetic tree of source files 
+    """
+    def __init__(self, root, opt, template):
+        self.root = root
+        self.opt = opt
+        self.template = template
+        self.rng = random.Random(opt.seed)
+        self.types = self.renderable(sorted(FT.types)) if opt.types == "all" else opt.types.split(",")
+        self.counts = {}
+        self.nbytes = 0 
+
+    def renderable(self, types):
+        """
+        :return types: excluding those for which the template cannot be rendered, currently erlang 
+        """
+        ok = []
+        for ftype in types:
+            try:
+                self.template.header(ftype)
+            except AssertionError:
+                log.warning("skipping type %s which fails to render" % ftype)
+                continue
+            pass
+            ok.append(ftype)
+        pass
+        return ok
+
+    def header(self, ftype, kind):
+        settings = FT.types[ftype]
+        if kind == "existing":
+            return list(self.template.header(ftype)[0])
+        elif kind == "foreign":
+            return self.template.render(settings, FOREIGN) 
+        else:
+            return []
+        pass
+
+    def body(self, ftype, nbytes):
+        lines = []
+        n = 0
+        i = 0 
+        while n < nbytes:
+            line = "value_%d = %d ;\n" % (i, self.rng.randint(0, 1000000))
+            lines.append(line)
+            n += len(line)
+            i += 1
+        pass
+        return lines
+
+    def kind(self):
+        u = self.rng.random()
+        if u < self.opt.existing: return "existing"
+        if u < self.opt.existing + self.opt.foreign: return "foreign"
+        return "missing"
+
+    def create(self):
+        for i in range(self.opt.files):
+            ftype = self.rng.choice(self.types)
+            ext = FT.types[ftype].extensions[0]
+            kind = self.kind()
+            fold = os.path.join(self.root, "d%03d" % (i % self.opt.dirs))
+            if not os.path.isdir(fold):
+                os.makedirs(fold)
+            pass
+            path = os.path.join(fold, "f%06d%s" % (i, ext))
+            text = "".join(self.header(ftype, kind) + self.body(ftype, self.opt.size))
+            with open(path, "w") as f:
+                f.write(text)
+            pass
+            self.nbytes += len(text)
+            key = "%s_%s" % (ftype, kind)
+            self.counts[key] = self.counts.get(key, 0) + 1 
+        pass
+
+
+def timed(name, func, nfiles, nbytes):
+    t0 = time.time()
+    c0 = time.clock() if not hasattr(time, "process_time") else time.process_time()
+    out = func()
+    c1 = time.clock() if not hasattr(time, "process_time") else time.process_time()
+    t1 = time.time()
+    wall = t1 - t0
+    r = dict(phase=name, wall=wall, cpu=c1-c0, files=nfiles, 
+             files_per_sec=nfiles/wall if wall > 0 else None, 
+             mb_per_sec=nbytes/1e6/wall if wall > 0 else None,
+             peak_rss_mb=peak_rss_mb())
+    log.info("%(phase)-10s wall %(wall)8.3f cpu %(cpu)8.3f files/s %(files_per_sec)10.1f MB/s %(mb_per_sec)8.2f rss %(peak_rss_mb)8.1f MB" % r)
+    return r, out
+
+
+def parse_opt(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=2000, help="Number of files")
+    parser.add_argument("--dirs", type=int, default=50, help="Number of directories the files are spread over")
+    parser.add_argument("--size", type=int, default=4000, help="Approximate bytes of body per file")
+    parser.add_argument("--types", default="all", help="Comma delimited file types, or all")
+    parser.add_argument("--existing", type=float, default=0.3, help="Fraction of files with the current header")
+    parser.add_argument("--foreign", type=float, default=0.1, help="Fraction of files with a foreign header")
+    parser.add_argument("--seed", type=int, default=1, help="Random seed")
+    parser.add_argument("--jobs", type=int, default=1, help="licensehd --jobs for the rewrite phases")
+    parser.add_argument("--dir", default=None, help="Directory for the tree, default a temporary directory that is removed")
+    parser.add_argument("--out", default=None, help="Path for the JSON results, default stdout")
+    parser.add_argument("--startup-runs", type=int, default=5, help="Number of fresh interpreters for the import time measurement")
+    parser.add_argument("--startup-budget-ms", type=float, default=100., help="Budget for the cold import time of licensehd")
+    parser.add_argument("--level", default="info", help="logging level")
+    return parser.parse_args(argv)
+
+
+def main():
+    opt = parse_opt()
+    logging.basicConfig(level=getattr(logging, opt.level.upper()), format="%(message)s")
+
+    root = opt.dir if opt.dir is not None else tempfile.mkdtemp(prefix="licensehd_bench_")
+    try:
+        args = parse_args([root, "--no-cache", "--level", "warning", "--jobs", str(opt.jobs), "--report", "none"])
+        corpus = Corpus(root, opt, args.template)
+        corpus.create()
+        n = opt.files
+        nb = corpus.nbytes 
+
+        phases = []
+        r, paths = timed("discover", lambda:list(get_paths(root)), n, nb) 
+        phases.append(r)
+        assert len(paths) == n, (len(paths), n)
+
+        r, _ = timed("classify", lambda:[LicenseHD(path, args).msg for path in paths], n, nb)
+        phases.append(r)
+
+        r, results = timed("rewrite", lambda:list(run(paths, args)), n, nb)
+        phases.append(r)
+
+        r, reresults = timed("rerun", lambda:list(run(paths, args)), n, nb)
+        phases.append(r)
+
+        actions = {}
+        for res in results:
+            actions[res["action"]] = actions.get(res["action"], 0) + 1
+        pass
+    finally:
+        if opt.dir is None:
+            shutil.rmtree(root)
+        pass
+    pass
+
+    ms = import_time_ms(runs=opt.startup_runs)
+    startup = dict(import_ms=ms, budget_ms=opt.startup_budget_ms, ok=ms is None or ms <= opt.startup_budget_ms)
+    log.info("startup    import %s ms budget %s ms ok %s " % (ms, opt.startup_budget_ms, startup["ok"]))
+
+    out = dict(commit=git_commit(), python=sys.version.split()[0], platform=sys.platform,
+               params=vars(opt), corpus=dict(nbytes=nb, counts=corpus.counts), 
+               actions=actions, phases=phases, startup=startup)
+    js = json.dumps(out, indent=2, sort_keys=True)
+    if opt.out is None:
+        print(js)
+    else:
+        with open(opt.out, "w") as f:
+            f.write(js + "\n")
+        pass
+    pass
+    return 0 if startup["ok"] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
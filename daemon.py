@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+"""
+daemon.py
+===========
+
+Long lived server keeping the FileTypes patterns, the LicenseTmpl renderings
+and the interpreter itself warm, serving check and apply requests over a
+local Unix socket. This avoids paying the licensehd.py startup for every file
+when invoked from editor save hooks or build rules::
+
+    python daemon.py --serve &                          # start the daemon
+    python daemon.py --check src/a.c src/b.py           # thin client
+    python daemon.py --stdin --ftype c < a.c > a2.c
+    python daemon.py --stop
+
+The client only imports the standard library modules it needs. When no daemon
+is listening on the socket the same request is handled in process, importing
+licensehd at that point, so the client can always be used.
+
+The socket is created in $XDG_RUNTIME_DIR, otherwise in a licensehd-<uid>
+directory of mode 0700 within the temporary directory. Its directory must be
+owned by the user and not writable by others. The client only talks to
+a socket owned by the user, served by a process of the user where the
+platform reports the peer credentials. The server refuses to replace a
+socket that is still served.
+
+Requests and responses are single JSON lines::
+
+    {"op": "apply"|"check", "paths": [...], "options": {"tmpl": "bsd-3", ...}}
+    {"op": "apply"|"check", "text": "...", "ftype": "c", "options": {...}}
+    {"results": [...]} or {"error": "..."}
+
+"""
+import os, sys, stat, json, socket, argparse, logging
+log = logging.getLogger(__name__)
+
+OPTIONS = ["tmpl", "years", "owner", "projname", "projurl", "encoding"]
+FMT = " %(action)-10s : %(msg)-20s : %(path)s"
+ESCAPE = "surrogateescape" if sys.version_info[0] > 2 else "strict"   # round trips undecodable bytes through the JSON
+
+
+def default_socket():
+    """
+    :return path: within XDG_RUNTIME_DIR, otherwise within a private directory of the user in the temporary directory
+    """
+    fold = os.environ.get("XDG_RUNTIME_DIR")
+    if not fold:
+        import tempfile
+        fold = os.path.join(tempfile.gettempdir(), "licensehd-%s" % os.getuid())
+    pass
+    return os.path.join(fold, "licensehd.sock")
+
+def untrusted(sockpath, sock=None):
+    """
+    :param sockpath: path of the socket
+    :param sock: optional connected socket, whose peer is checked where SO_PEERCRED is available
+    :return reason: why the socket is not trusted, None when it is a socket owned by the user
+                    within a directory owned by the user and not writable by others
+    """
+    uid = os.getuid()
+    fold = os.path.dirname(os.path.abspath(sockpath))
+    try:
+        st = os.lstat(sockpath)
+        dst = os.stat(fold)
+    except OSError as err:
+        return str(err)
+    pass
+    if dst.st_uid != uid or dst.st_mode & 0o022:
+        return "directory %s is not owned by uid %d or is writable by others " % (fold, uid)
+    pass
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != uid:
+        return "%s is not a socket owned by uid %d " % (sockpath, uid)
+    pass
+    if sock is not None and hasattr(socket, "SO_PEERCRED"):
+        import struct
+        pid, puid, pgid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+        if puid != uid:
+            return "%s is served by pid %d of uid %d " % (sockpath, pid, puid)
+        pass
+    pass
+    return None
+
+
+class Handler(object):
+    """
+    Executes requests, memoizing the parsed licensehd args with their LicenseTmpl
+    for each distinct set of options. Used by the server and by the in-process fallback.
+    """
+    def __init__(self):
+        import licensehd
+        self.lhd = licensehd
+        self.args = {}
+
+    def get_args(self, options):
+        key = tuple((k, options.get(k)) for k in OPTIONS)
+        args = self.args.get(key)
+        if args is None:
+            argv = ["--no-cache", "--report", "none"]
+            for k, v in key:
+                if v is None: continue
+                argv += ["--enc" if k == "encoding" else "--%s" % k, v]
+            pass
+            try:
+                args = self.lhd.parse_args(argv + ["."])
+            except SystemExit:
+                raise ValueError("invalid options %s " % json.dumps(dict((k, v) for k, v in key if v is not None)))   # parser.error exits
+            pass
+            self.args[key] = args
+        pass
+        return args
+
+    def __call__(self, req):
+        args = self.get_args(req.get("options", {}))
+        check = req.get("op") == "check"
+        if "text" in req:
+            try:
+                r = self.lhd.apply_header(req["text"], req["ftype"], args.template, encoding=args.encoding, check=check)
+            except (UnicodeError, AssertionError, IOError, OSError) as err:    # as process_path
+                r = self.lhd.error_result("<stdin>", err)
+                r["text"] = req["text"]    # passed through unchanged 
+            pass
+            return dict(results=[r])
+        pass
+        args = argparse.Namespace(**vars(args))
+        args.check = check
+        return dict(results=[self.lhd.process_path(path, args) for path in req["paths"]])
+
+    def safe(self, req):
+        try:
+            return self(req)
+        except (Exception, SystemExit) as err:
+            log.exception("request failed")
+            return dict(error="%s: %s" % (type(err).__name__, err))
+        pass
+
+
+def serve(sockpath):
+    """
+    :return rc: non-zero when the socket cannot be served 
+    """
+    fold = os.path.dirname(os.path.abspath(sockpath))
+    if not os.path.isdir(fold):
+        os.makedirs(fold, 0o700)
+    pass
+    if os.path.lexists(sockpath):
+        if request(sockpath, None) is not None:
+            log.fatal("a daemon is already serving on %s " % sockpath)
+            return 1
+        pass
+        reason = untrusted(sockpath)
+        if reason is not None:
+            log.fatal("refusing to replace %s : %s" % (sockpath, reason))
+            return 1
+        pass
+        os.remove(sockpath)    # left behind by a daemon that is gone 
+    else:
+        st = os.stat(fold)
+        if st.st_uid != os.getuid() or st.st_mode & 0o022:
+            log.fatal("refusing to serve on %s : directory not owned by uid %d or writable by others " % (sockpath, os.getuid()))
+            return 1
+        pass
+    pass
+    try:
+        import socketserver
+    except ImportError:
+        import SocketServer as socketserver   # py2
+    pass
+    handler = Handler()
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                req = json.loads(line.decode("utf-8"))
+                if req.get("op") == "stop":
+                    self.wfile.write(b'{"results": []}\n')
+                    server._stop = True
+                    return
+                pass
+                resp = handler.safe(req)
+                self.wfile.write(json.dumps(resp).encode("utf-8") + b"\n")
+            pass
+
+    server = socketserver.ThreadingUnixStreamServer(sockpath, RequestHandler)
+    os.chmod(sockpath, 0o600)
+    server.daemon_threads = True
+    server.timeout = 0.5    # handle_request returns periodically to notice a stop
+    server._stop = False
+    log.info("serving on %s " % sockpath)
+    try:
+        while not server._stop:
+            server.handle_request()
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(sockpath):
+            os.remove(sockpath)
+        pass
+    pass
+    return 0
+
+
+def request(sockpath, req):
+    """
+    :param req: dict, or None to only probe for a listening daemon
+    :return resp: from the daemon, an error when it closed the connection without reply 
+                  or the socket is not trusted, None when there is no daemon listening
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(sockpath)
+    except (OSError, socket.error):
+        s.close()
+        return None
+    pass
+    if req is None:
+        s.close()
+        return {}
+    pass
+    reason = untrusted(sockpath, s)
+    if reason is not None:
+        s.close()
+        return dict(error="not using the daemon socket %s : %s" % (sockpath, reason))
+    pass
+    try:
+        s.sendall(json.dumps(req).encode("utf-8") + b"\n")
+        f = s.makefile("rb")
+        line = f.readline()
+        f.close()
+    finally:
+        s.close()
+    pass
+    if not line.strip():
+        return dict(error="no reply from the daemon on %s, see its log " % sockpath)
+    pass
+    return json.loads(line.decode("utf-8"))
+
+
+def parse_opt(argv=None):
+    parser = argparse.ArgumentParser(description="licensehd daemon and thin client")
+    parser.add_argument("paths", nargs="*", default=[], help="File paths to process")
+    parser.add_argument("--serve", action="store_true", default=False, help="Run the daemon in the foreground")
+    parser.add_argument("--stop", action="store_true", default=False, help="Ask the daemon to exit")
+    parser.add_argument("--socket", default=default_socket(), help="Path of the Unix socket")
+    parser.add_argument("--check", action="store_true", default=False, help="Read only check, non-zero exit for missing or stale headers")
+    parser.add_argument("--stdin", action="store_true", default=False, help="Filter stdin to stdout, requires --ftype")
+    parser.add_argument("--ftype", default=None, help="File type of the --stdin content")
+    parser.add_argument("--tmpl", default=None, help="Template name")
+    parser.add_argument("--years", default=None, help="Year range")
+    parser.add_argument("--owner", default=None, help="Name of copyright owner")
+    parser.add_argument("--projname", default=None, help="Name of project")
+    parser.add_argument("--projurl", default=None, help="Url of project")
+    parser.add_argument("--enc", dest="encoding", default=None, help="Encoding of program files")
+    parser.add_argument("--level", default="info", help="logging level")
+    return parser.parse_args(argv)
+
+
+def main():
+    opt = parse_opt()
+    logging.basicConfig(level=getattr(logging, opt.level.upper()), format="%(message)s")
+    if opt.serve:
+        return serve(opt.socket)
+    elif opt.stop:
+        resp = request(opt.socket, dict(op="stop"))
+        if resp is not None and "error" in resp:
+            log.fatal(resp["error"])
+        pass
+        return 0 if resp is not None and not "error" in resp else 1
+    pass
+
+    options = dict((k, getattr(opt, k)) for k in OPTIONS if getattr(opt, k) is not None)
+    req = dict(op="check" if opt.check else "apply", options=options)
+    if opt.stdin:
+        if opt.ftype is None:
+            log.fatal("--stdin requires --ftype")
+            return 2
+        pass
+        stdin = getattr(sys.stdin, "buffer", sys.stdin)
+        try:
+            req["text"] = stdin.read().decode(opt.encoding or "utf-8", ESCAPE)
+        except LookupError as err:
+            log.fatal(str(err))
+            return 2
+        pass
+        req["ftype"] = opt.ftype
+    else:
+        req["paths"] = [os.path.abspath(path) for path in opt.paths]
+    pass
+
+    resp = request(opt.socket, req)
+    if resp is None:
+        log.debug("no daemon on %s, handling in process " % opt.socket)
+        resp = Handler().safe(req)
+    pass
+    if "error" in resp:
+        log.fatal(resp["error"])
+        return 2
+    pass
+
+    rc = 0
+    for r in resp["results"]:
+        failed = r["action"] in ("stale", "missing", "failed")
+        if failed:
+            rc = 1
+        pass
+        if opt.stdin and not opt.check:
+            stdout = getattr(sys.stdout, "buffer", sys.stdout)
+            stdout.write(r["text"].encode(opt.encoding or "utf-8", ESCAPE))
+        elif not opt.stdin and (failed or not opt.check):
+            print(FMT % r)
+        pass
+    pass
+    return rc
+
+
+if __name__ == '__main__':
+    sys.exit(main())
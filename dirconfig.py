@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+dirconfig.py
+==============
+
+Per-directory configuration, so a single run can handle a tree with subtrees
+of different owners or licenses, such as vendored code or sub-projects::
+
+    # ~/monorepo/vendor/foo/.licensehd
+    tmpl = bsd-3
+    owner = Foo Developers
+    projname = Foo
+    projurl = https://example.org/foo
+    years = 2012-2020
+
+A .licensehd file applies to its directory and everything beneath it. The
+keys are named after the command line options and override them, and
+also override the .licensehd files of enclosing directories, key by key.
+Enclosing directories are searched up to the first config with
+"root = true", the top of a git work tree or the filesystem root.
+Unknown keys and malformed lines are ignored with a warning. With
+--git-years the per file history still takes precedence over the years
+of a config.
+
+Each directory is resolved once and the result cached, which costs one
+stat per directory. Directories with the same effective settings share a
+single LicenseTmpl. That template memoizes its rendering per file type,
+so the header for each distinct combination of settings and file type
+is rendered only once. Use --no-config to ignore .licensehd files.
+
+"""
+import os, hashlib, logging
+log = logging.getLogger(__name__)
+
+from collections import OrderedDict as odict
+from py2open import open
+
+
+KEYS = ["tmpl", "years", "owner", "projname", "projurl"]
+
+
+def parse_config(path):
+    """
+    :param path: of a .licensehd file
+    :return odict: of the "key = value" settings, and root when present
+    """
+    d = odict()
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.readlines()
+    pass
+    for i, line in enumerate(lines):
+        line = line.strip()
+        if not line or line.startswith("#"): continue
+        key, sep, value = line.partition("=")
+        key, value = key.strip(), value.strip()
+        if sep != "=" or not (key in KEYS or key == "root"):
+            log.warning("ignoring %s:%d : %r " % (path, i+1, line))
+            continue
+        pass
+        d[key] = value
+    pass
+    return d
+
+
+class DirConfigs(object):
+    """
+    Resolves the effective settings of directories from the .licensehd files,
+    on top of the command line settings of args
+    """
+    name = ".licensehd"
+
+    def __init__(self, args):
+        self.base = tuple((key, getattr(args, key)) for key in KEYS)
+        self.resolved = {}    # directory -> settings tuple
+        self.templates = {self.base:args.template}    # settings tuple -> LicenseTmpl, shared by all directories with those settings
+        self.digests = {self.base:None}
+        self.nconfig = 0
+
+    def load(self, fold):
+        path = os.path.join(fold, self.name)
+        if not os.path.isfile(path):
+            return None
+        pass
+        self.nconfig += 1
+        return parse_config(path)
+
+    def resolve(self, fold):
+        """
+        :param fold: directory
+        :return settings: tuple of (key, value) pairs in the order of KEYS
+        """
+        fold = os.path.abspath(fold)
+        settings = self.resolved.get(fold)
+        if settings is not None: return settings
+        cfg = self.load(fold)
+        parent = os.path.dirname(fold)
+        if parent == fold or (cfg is not None and cfg.get("root") == "true") or os.path.exists(os.path.join(fold, ".git")):
+            settings = self.base
+        else:
+            settings = self.resolve(parent)
+        pass
+        if cfg is not None:
+            settings = tuple((key, cfg.get(key, value)) for key, value in settings)
+        pass
+        self.resolved[fold] = settings
+        return settings
+
+    def template(self, path):
+        """
+        :param path: of a file
+        :return LicenseTmpl: for the settings of the directory of the path
+        """
+        settings = self.resolve(os.path.dirname(path) or ".")
+        tmpl = self.templates.get(settings)
+        if tmpl is None:
+            from licensehd import load_template
+            d = dict(settings)
+            tmpl = load_template(d["tmpl"], d["years"], d["owner"], d["projname"], d["projurl"])   # IOError for an unknown template
+            log.debug("%r loaded template for %s : %r " % (self, os.path.dirname(path), d))
+            self.templates[settings] = tmpl
+        pass
+        return tmpl
+
+    def digest(self, path):
+        """
+        :param path: of a file
+        :return digest: of the template of the path, None when that of the command line
+        """
+        settings = self.resolve(os.path.dirname(path) or ".")
+        if not settings in self.digests:
+            h = hashlib.sha1(repr(settings).encode("utf-8"))
+            try:
+                for line in self.template(path).lines:
+                    h.update(line.encode("utf-8"))
+                pass
+            except (IOError, OSError):
+                pass    # the files fail and are not cached
+            pass
+            self.digests[settings] = h.hexdigest()
+        pass
+        return self.digests[settings]
+
+    def __repr__(self):
+        return "DirConfigs configs %d dirs %d templates %d " % (self.nconfig, len(self.resolved), len(self.templates))
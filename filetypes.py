@@ -10,18 +10,153 @@
 
 """
 
-import os
+import os, threading
 from collections import OrderedDict as odict 
-import regex as re
+
+
+def compile_pattern(ptn):
+    """
+    Patterns are compiled lazily, when the type is first used, preferring 
+    the third party regex module and falling back to the standard re.
+    """
+    try:
+        import regex as re
+    except ImportError:
+        import re
+    pass
+    return re.compile(ptn)
+
+
+class TypeSettings(object):
+    """
+    Immutable settings for one file type, shared by all files of the type. 
+    Supports the item access of the typeSettings dicts it is created from, 
+    with the pattern strings compiled.
+    """
+    __slots__ = ("ftype", "extensions", "filenames", "keepFirst", 
+                 "blockCommentStartPattern", "blockCommentEndPattern", 
+                 "lineCommentStartPattern", "lineCommentEndPattern", 
+                 "headerStartLine", "headerEndLine", "headerLinePrefix", "headerLineSuffix" )
+    patterns = ("keepFirst", "blockCommentStartPattern", "blockCommentEndPattern", "lineCommentStartPattern", "lineCommentEndPattern")
+
+    def __init__(self, ftype, d):
+        object.__setattr__(self, "ftype", ftype)
+        for k in self.__slots__[1:]:
+            v = d.get(k)
+            if k in ("extensions", "filenames"):
+                v = tuple(v or ())
+            elif k in self.patterns and v is not None and not hasattr(v, "search"):
+                v = compile_pattern(v)
+            pass
+            object.__setattr__(self, k, v)
+        pass
+
+    def __setattr__(self, k, v):
+        raise AttributeError("TypeSettings are immutable")
+
+    def __reduce__(self):
+        return (TypeSettings, (self.ftype, dict(self.items())))
+
+    def __getitem__(self, k):
+        return getattr(self, k)
+
+    def get(self, k, default=None):
+        return getattr(self, k, default)
+
+    def items(self):
+        return [(k, getattr(self, k)) for k in self.__slots__]
+
+    def __repr__(self):
+        return "TypeSettings %s %r " % (self.ftype, self.extensions)
+
+
+class TypeTable(object):
+    """
+    Read only mapping of ftype to TypeSettings, creating each 
+    on first access so only the patterns of types in use get compiled.
+    """
+    def __init__(self, typeSettings):
+        self.typeSettings = typeSettings
+        self.d = {}
+        self.lock = threading.Lock()
+
+    def get(self, ftype, default=None):
+        if not ftype in self.typeSettings: return default
+        settings = self.d.get(ftype)
+        if settings is None:
+            with self.lock:
+                settings = self.d.get(ftype)
+                if settings is None:
+                    settings = TypeSettings(ftype, self.typeSettings[ftype])
+                    self.d[ftype] = settings
+                pass
+            pass
+        pass
+        return settings
+
+    def __getitem__(self, ftype):
+        settings = self.get(ftype)
+        if settings is None: raise KeyError(ftype)
+        return settings
+
+    def __contains__(self, ftype):
+        return ftype in self.typeSettings
+
+    def __iter__(self):
+        return iter(self.typeSettings)
+
+    def __len__(self):
+        return len(self.typeSettings)
+
+
+class LRU(object):
+    """
+    Small thread safe least recently used cache 
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.d = odict()
+        self.lock = threading.Lock()
+
+    def get(self, k, default=None):
+        with self.lock:
+            if not k in self.d: return default
+            v = self.d.pop(k) 
+            self.d[k] = v
+            return v
+
+    def put(self, k, v):
+        with self.lock:
+            self.d.pop(k, None)
+            self.d[k] = v
+            if len(self.d) > self.maxsize:
+                self.d.popitem(last=False)
+            pass
+        pass
+
 
 class FileTypes(object):
+    """
+    Types are resolved from the file basename, in order of precedence:
+
+    1. whole basename in "filenames", eg SConstruct 
+    2. longest dotted suffix in "extensions", allowing multi-dot extensions
+    3. for names without any dot, the interpreter of a "#!" first line 
+
+    """
+    interpreters = {
+        "python":"python", 
+        "sh":"script", "bash":"script", "csh":"script", "tcsh":"script", "zsh":"script", "ksh":"script",
+        "perl":"perl", 
+        "ruby":"ruby",
+    }
     typeSettings = {
         "java": {
             "extensions": [".java", ".scala", ".groovy", ".jape", ".js"],
             "keepFirst": None,
-            "blockCommentStartPattern": re.compile(r'^\s*/\*'),
-            "blockCommentEndPattern": re.compile(r'\*/\s*$'),
-            "lineCommentStartPattern": re.compile(r'\s*//'),
+            "blockCommentStartPattern": r'^\s*/\*',
+            "blockCommentEndPattern": r'\*/\s*$',
+            "lineCommentStartPattern": r'\s*//',
             "lineCommentEndPattern": None,
             "headerStartLine": "/*\n",
             "headerEndLine": " */\n",
@@ -30,10 +165,10 @@ class FileTypes(object):
         },
         "script": {
             "extensions": [".sh", ".csh", ".pl", ".bash"],
-            "keepFirst": re.compile(r'^#!|^# -\*-'),
+            "keepFirst": r'^#!|^# -\*-',
             "blockCommentStartPattern": None,
             "blockCommentEndPattern": None,
-            "lineCommentStartPattern": re.compile(r'\s*#'),
+            "lineCommentStartPattern": r'\s*#',
             "lineCommentEndPattern": None,
             "headerStartLine": "##\n",
             "headerEndLine": "##\n",
@@ -42,10 +177,10 @@ class FileTypes(object):
         },
         "perl": {
             "extensions": [".pl"],
-            "keepFirst": re.compile(r'^#!|^# -\*-'),
+            "keepFirst": r'^#!|^# -\*-',
             "blockCommentStartPattern": None,
             "blockCommentEndPattern": None,
-            "lineCommentStartPattern": re.compile(r'\s*#'),
+            "lineCommentStartPattern": r'\s*#',
             "lineCommentEndPattern": None,
             "headerStartLine": "##\n",
             "headerEndLine": "##\n",
@@ -54,10 +189,11 @@ class FileTypes(object):
         },
         "python": {
             "extensions": [".py"],
-            "keepFirst": re.compile(r'^#!|^# +pylint|^# +-\*-|^#-\*-|^# +coding|^# +encoding'),
+            "filenames": ["SConstruct", "SConscript"],
+            "keepFirst": r'^#!|^# +pylint|^# +-\*-|^#-\*-|^# +coding|^# +encoding',
             "blockCommentStartPattern": None,
             "blockCommentEndPattern": None,
-            "lineCommentStartPattern": re.compile(r'\s*#'),
+            "lineCommentStartPattern": r'\s*#',
             "lineCommentEndPattern": None,
             "headerStartLine": "#\n",
             "headerEndLine": "#\n",
@@ -66,9 +202,9 @@ class FileTypes(object):
         },
         "xml": {
             "extensions": [".xml"],
-            "keepFirst": re.compile(r'^\s*<\?xml.*\?>'),
-            "blockCommentStartPattern": re.compile(r'^\s*<!--'),
-            "blockCommentEndPattern": re.compile(r'-->\s*$'),
+            "keepFirst": r'^\s*<\?xml.*\?>',
+            "blockCommentStartPattern": r'^\s*<!--',
+            "blockCommentEndPattern": r'-->\s*$',
             "lineCommentStartPattern": None,
             "lineCommentEndPattern": None,
             "headerStartLine": "<!--\n",
@@ -79,9 +215,9 @@ class FileTypes(object):
         "sql": {
             "extensions": [".sql"],
             "keepFirst": None,
-            "blockCommentStartPattern": None,  # re.compile('^\s*/\*'),
-            "blockCommentEndPattern": None,  # re.compile(r'\*/\s*$'),
-            "lineCommentStartPattern": re.compile(r'\s*--'),
+            "blockCommentStartPattern": None,  # '^\s*/\*',
+            "blockCommentEndPattern": None,  # r'\*/\s*$',
+            "lineCommentStartPattern": r'\s*--',
             "lineCommentEndPattern": None,
             "headerStartLine": "--\n",
             "headerEndLine": "--\n",
@@ -89,11 +225,11 @@ class FileTypes(object):
             "headerLineSuffix": None
         },
         "c": {
-            "extensions": [".c", ".cc", ".cpp", "c++", ".h", ".hpp", ".hh", ".cu", ".cuh", ".m", ".mm" ],
+            "extensions": [".c", ".cc", ".cpp", ".c++", ".h", ".hpp", ".hh", ".cu", ".cuh", ".m", ".mm" ],
             "keepFirst": None,
-            "blockCommentStartPattern": re.compile(r'^\s*/\*'),
-            "blockCommentEndPattern": re.compile(r'\*/\s*$'),
-            "lineCommentStartPattern": re.compile(r'\s*//'),
+            "blockCommentStartPattern": r'^\s*/\*',
+            "blockCommentEndPattern": r'\*/\s*$',
+            "lineCommentStartPattern": r'\s*//',
             "lineCommentEndPattern": None,
             "headerStartLine": "/*\n",
             "headerEndLine": " */\n",
@@ -102,10 +238,10 @@ class FileTypes(object):
         },
         "glsl": {
             "extensions": [".glsl" ],
-            "keepFirst": re.compile(r'^#version'),
-            "blockCommentStartPattern": re.compile(r'^\s*/\*'),
-            "blockCommentEndPattern": re.compile(r'\*/\s*$'),
-            "lineCommentStartPattern": re.compile(r'\s*//'),
+            "keepFirst": r'^#version',
+            "blockCommentStartPattern": r'^\s*/\*',
+            "blockCommentEndPattern": r'\*/\s*$',
+            "lineCommentStartPattern": r'\s*//',
             "lineCommentEndPattern": None,
             "headerStartLine": "/*\n",
             "headerEndLine": " */\n",
@@ -114,10 +250,10 @@ class FileTypes(object):
         },
         "ruby": {
             "extensions": [".rb"],
-            "keepFirst": "^#!",
-            "blockCommentStartPattern": re.compile('^=begin'),
-            "blockCommentEndPattern": re.compile(r'^=end'),
-            "lineCommentStartPattern": re.compile(r'\s*#'),
+            "keepFirst": r'^#!',
+            "blockCommentStartPattern": '^=begin',
+            "blockCommentEndPattern": r'^=end',
+            "lineCommentStartPattern": r'\s*#',
             "lineCommentEndPattern": None,
             "headerStartLine": "##\n",
             "headerEndLine": "##\n",
@@ -129,7 +265,7 @@ class FileTypes(object):
             "keepFirst": None,
             "blockCommentStartPattern": None,
             "blockCommentEndPattern": None,
-            "lineCommentStartPattern": re.compile(r'\s*//'),
+            "lineCommentStartPattern": r'\s*//',
             "lineCommentEndPattern": None,
             "headerStartLine": None,
             "headerEndLine": None,
@@ -141,7 +277,7 @@ class FileTypes(object):
             "keepFirst": None,
             "blockCommentStartPattern": None,
             "blockCommentEndPattern": None,
-            "lineCommentStartPattern": re.compile(r"^\s*\'"),
+            "lineCommentStartPattern": r"^\s*\'",
             "lineCommentEndPattern": None,
             "headerStartLine": None,
             "headerEndLine": None,
@@ -164,24 +300,78 @@ class FileTypes(object):
 
     def __init__(self):
         ext2type = odict() 
+        name2type = {}
         patterns = []
         for k in self.typeSettings:
-            exts = self.typeSettings[k]["extensions"]
-            for ext in exts:
+            for ext in self.typeSettings[k]["extensions"]:
                 ext2type[ext] = k
                 patterns.append("*" + ext)
             pass 
+            for name in self.typeSettings[k].get("filenames", []):
+                name2type[name] = k
+                patterns.append(name)
+            pass 
         pass
+        self.types = TypeTable(self.typeSettings)
         self.ext2type = ext2type
+        self.name2type = name2type
         self.patterns = patterns
+        self.sniffed = LRU()
+
+    def ftype_of(self, name):
+        """
+        :param name: file basename
+        :return ftype: or None when the name is not recognized  
+        """
+        ftype = self.name2type.get(name)
+        if ftype is not None: return ftype
+        i = name.find(".", 1)    # skip the leading dot of hidden files
+        while i > -1:
+            ftype = self.ext2type.get(name[i:])
+            if ftype is not None: return ftype
+            i = name.find(".", i+1)
+        pass
+        return None
+
+    def sniff(self, path):
+        """
+        :param path: of file without extension
+        :return ftype: from the interpreter of a "#!" first line, or None 
+        """
+        ftype = self.sniffed.get(path, "")
+        if ftype != "": return ftype
+
+        ftype = None 
+        try:
+            with open(path, "rb") as f:
+                first = f.read(128)
+            pass
+        except (IOError, OSError):
+            first = b""
+        pass
+        if first.startswith(b"#!"):
+            words = first[2:].split(b"\n")[0].decode("latin-1").split()
+            if len(words) > 1 and os.path.basename(words[0]) == "env":
+                words = [w for w in words[1:] if not w.startswith("-")]
+            pass
+            if len(words) > 0: 
+                interp = os.path.basename(words[0]).rstrip("0123456789.")   # python3.8 -> python
+                ftype = self.interpreters.get(interp)
+            pass
+        pass
+        self.sniffed.put(path, ftype)
+        return ftype
 
     def __call__(self, path):
-        ext = os.path.splitext(path)[1]
-        ftype = self.ext2type.get(ext)
-        settings = self.typeSettings.get(ftype)
-        settings["ftype"] = ftype 
-        settings["path"] = path 
-        return settings
+        """
+        :return settings: TypeSettings of the path, or None when not recognized
+        """
+        name = os.path.basename(path)
+        ftype = self.ftype_of(name)
+        if ftype is None and not "." in name:
+            ftype = self.sniff(path)
+        pass
+        return self.types.get(ftype)
 
 
 if __name__ == '__main__':
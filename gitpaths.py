@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+"""
+gitpaths.py
+=============
+
+Candidate paths obtained from the local git repository in a single batch call,
+so that pre-commit hooks and PR runs scale with the size of the change rather
+than the size of the tree.
+
+::
+
+    licensehd.py ~/opticks --git-staged          # files in the index differing from HEAD
+    licensehd.py ~/opticks --git-diff main       # files changed relative to a revision
+    licensehd.py ~/opticks --git-ls-files        # all tracked files, without walking
+
+Paths are listed NUL-separated with -z so unusual names need no unquoting.
+Deleted files are excluded.
+
+Also git_years which indexes the first and last year each file was touched 
+from a single git log pass, used by::
+
+    licensehd.py ~/opticks --git-years --update
+
+"""
+import os, sys, logging, subprocess
+log = logging.getLogger(__name__)
+
+MODES = {
+    "staged":   ["diff", "--cached", "--name-only", "-z", "--relative", "--diff-filter=ACMR"],
+    "diff":     ["diff", "--name-only", "-z", "--relative", "--diff-filter=ACMR"],
+    "ls-files": ["ls-files", "-z"],
+}
+
+def git(cmd, cwd):
+    """
+    :param cmd: list of git arguments
+    :param cwd: directory within the repository
+    :return bytes: stdout of the command
+    """
+    return subprocess.check_output(["git"] + cmd, cwd=cwd)
+
+def split_z(out):
+    """
+    :param out: NUL-separated bytes
+    :return: list of str names
+    """
+    names = [name for name in out.split(b"\0") if name]
+    if sys.version_info[0] > 2:
+        names = [os.fsdecode(name) for name in names]
+    pass
+    return names
+
+def git_paths(root, mode, rev=None):
+    """
+    :param root: directory within a git repository, the listing is limited to below it
+    :param mode: one of the MODES keys
+    :param rev: revision to diff against for mode "diff"
+    :return: list of existing paths joined onto root
+    """
+    cmd = list(MODES[mode])
+    if mode == "diff":
+        assert rev is not None, "mode diff requires a rev"
+        cmd.append(rev)
+    pass
+    names = split_z(git(cmd + ["--", "."], root))
+    paths = [os.path.join(root, name) for name in names]
+    log.debug("git_paths %s %s %s : %d " % (root, mode, rev, len(paths)))
+    return [path for path in paths if os.path.isfile(path)]
+
+
+def iter_z(stream, bufsize=1<<16):
+    """
+    :param stream: binary file like object 
+    :return: generator of the NUL-separated bytes tokens read from the stream in chunks
+    """
+    tail = b""
+    while True:
+        buf = stream.read(bufsize)
+        if not buf: break
+        tokens = (tail + buf).split(b"\0")
+        tail = tokens.pop()
+        for token in tokens:
+            yield token
+        pass
+    pass
+    if tail:
+        yield tail
+    pass
+
+def git_years(root):
+    """
+    :param root: directory within a git repository
+    :return dict: realpath of each file touched below root -> (first year, last year) 
+
+    Built from a single streamed pass over::
+
+        git log -z --name-only --format=%x01%ad --date=short -- .
+
+    in which each commit contributes a "\\x01YYYY-MM-DD" token followed by the 
+    names of the files it touched, the first of them prefixed by a newline.
+    Author dates are used. 
+    """
+    top = git(["rev-parse", "--show-toplevel"], root).strip()
+    if sys.version_info[0] > 2:
+        top = os.fsdecode(top)
+    pass
+    top = os.path.realpath(top)
+    cmd = ["git", "log", "-z", "--name-only", "--format=%x01%ad", "--date=short", "--", "."]
+    proc = subprocess.Popen(cmd, cwd=root, stdout=subprocess.PIPE)
+    index = {}
+    year = None
+    ncommit = 0 
+    for token in iter_z(proc.stdout):
+        if token.startswith(b"\x01"):
+            year = int(token[1:5])
+            ncommit += 1 
+            continue
+        pass
+        if token.startswith(b"\n"):
+            token = token[1:]
+        pass
+        if not token or year is None: continue
+        name = os.fsdecode(token) if sys.version_info[0] > 2 else token
+        path = os.path.join(top, name)
+        yrs = index.get(path)
+        if yrs is None:
+            index[path] = (year, year)
+        elif year < yrs[0] or year > yrs[1]:
+            index[path] = (min(year, yrs[0]), max(year, yrs[1]))
+        pass
+    pass
+    proc.stdout.close()
+    rc = proc.wait()
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    pass
+    log.debug("git_years %s commits %d paths %d " % (root, ncommit, len(index)))
+    return index
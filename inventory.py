@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""
+inventory.py
+==============
+
+Persistent index of the headers found at the top of every file, built by a
+read only licensehd.py run, which may be parallel::
+
+    licensehd.py ~/opticks --inventory -j 8     # writes ~/opticks/.licensehd.inventory
+
+Each file is recorded with its type, msg, comment kind, headStart and headEnd, and
+the fingerprint of its header block. The fingerprint is a hash of the header
+normalized by header_fingerprint: comment decoration, case, whitespace and
+years are removed so that the same license text clusters together across file
+types and year ranges. Queries are answered from the index without touching the files::
+
+    python inventory.py clusters --db ~/opticks/.licensehd.inventory         # clusters by fingerprint, largest first
+    python inventory.py clusters --msg has_other_license                     # foreign licenses only
+    python inventory.py show 3fa2                                            # normalized text of a header
+    python inventory.py files 3fa2                                           # files carrying the header
+    python inventory.py diff                                                 # changes since the previous inventory
+
+Each inventory is stored as a run, the last keep runs are retained for diff.
+Files whose mtime and size are unchanged since the previous run with the
+same licensehd fingerprint (template, encoding, ...), combined as in the
+StatCache with the .licensehd settings of their directory, are carried
+forward without being read, so re-inventories cost a stat per file.
+
+"""
+import os, sys, re, time, hashlib, logging, threading
+log = logging.getLogger(__name__)
+
+DECORATION = " \t\r\n#/*!%'-<>=;"
+YEARS = re.compile(r"\b(?:19|20)[0-9][0-9](?:\s*[-,]\s*(?:19|20)?[0-9][0-9])*\b")
+SPACE = re.compile(r"\s+")
+
+
+def normalize(line):
+    """
+    :return str: line without comment decoration and years, lowercased with whitespace collapsed
+    """
+    line = YEARS.sub("yyyy", line.strip(DECORATION))
+    return SPACE.sub(" ", line).lower()
+
+def header_fingerprint(header):
+    """
+    :param header: lines of the header block, LicenseHD._header
+    :return (fingerprint, text): short hexdigest and the normalized text, or (None, None) without a header
+    """
+    if header is None:
+        return None, None
+    pass
+    lines = [line for line in map(normalize, header) if line]
+    text = "\n".join(lines)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:16], text
+
+
+class Inventory(object):
+    """
+    SQLite backed index, only accessed from the parent process.
+    As with StatCache the lock is needed as the pool task feeder thread
+    drives filter while the main thread does the record.
+    """
+    name = ".licensehd.inventory"
+    keep = 2
+    commit_every = 1000
+    columns = ["path", "mtime", "size", "ftype", "msg", "action", "comment", "headStart", "headEnd", "fingerprint", "lhd"]
+
+    @classmethod
+    def default_path(cls, args):
+        """
+        :return path: in the directory being processed, or the invoking directory
+        """
+        from statcache import StatCache
+        return os.path.join(StatCache.default_root(args), cls.name)
+
+    def __init__(self, path, lhd_fingerprint=None, root=None, configs=None):
+        """
+        :param path: of the index
+        :param lhd_fingerprint: StatCache.fingerprint of the run, None to only query
+        :param root: processed, recorded with the run
+        :param configs: DirConfigs, whose digest is folded into the fingerprint of paths under a .licensehd
+        """
+        import sqlite3
+        self.path = path
+        self.lhd = lhd_fingerprint
+        self.configs = configs
+        self.fingerprints = {}   # DirConfigs digest -> combined fingerprint 
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY AUTOINCREMENT, time REAL, root TEXT, lhd TEXT, nfiles INTEGER, complete INTEGER)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (run INTEGER, path TEXT, mtime INTEGER, size INTEGER, ftype TEXT, msg TEXT, action TEXT, comment TEXT, headStart INTEGER, headEnd INTEGER, fingerprint TEXT, lhd TEXT, PRIMARY KEY (run, path))")
+        if not "lhd" in [col[1] for col in self.conn.execute("PRAGMA table_info(files)")]:
+            self.conn.execute("ALTER TABLE files ADD COLUMN lhd TEXT")    # inventories from before, whose rows are then not carried forward
+        pass
+        self.conn.execute("CREATE INDEX IF NOT EXISTS files_fingerprint ON files (run, fingerprint)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS headers (fingerprint TEXT PRIMARY KEY, text TEXT)")
+        self.run = None
+        self.prior = None
+        self.pending = 0
+        self.carried = 0
+        self.nfiles = 0
+        self.headers = set()
+        if lhd_fingerprint is not None:
+            self.begin(lhd_fingerprint, root)
+        pass
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def fingerprint_of(self, path):
+        """
+        :return fingerprint: of the run, combined with that of the template of the path when overridden by a .licensehd
+        """
+        digest = None if self.configs is None else self.configs.digest(path)
+        if digest is None: return self.lhd
+        fp = self.fingerprints.get(digest)
+        if fp is None:
+            fp = hashlib.sha1((self.lhd + digest).encode("utf-8")).hexdigest()
+            self.fingerprints[digest] = fp
+        pass
+        return fp
+
+    def runs(self):
+        """
+        :return list: of complete run ids, latest last
+        """
+        return [run for (run,) in self.execute("SELECT run FROM runs WHERE complete = 1 ORDER BY run")]
+
+    def begin(self, lhd_fingerprint, root):
+        self.execute("DELETE FROM files WHERE run IN (SELECT run FROM runs WHERE complete = 0)")   # from an interrupted run
+        self.execute("DELETE FROM runs WHERE complete = 0")
+        runs = self.runs()
+        if len(runs) > 0:
+            rows = self.execute("SELECT lhd FROM runs WHERE run = ?", (runs[-1],))
+            self.prior = runs[-1] if rows[0][0] == lhd_fingerprint else None
+        pass
+        with self.lock:
+            cur = self.conn.execute("INSERT INTO runs (time, root, lhd, nfiles, complete) VALUES (?,?,?,0,0)", (time.time(), root, lhd_fingerprint))
+            self.run = cur.lastrowid
+        pass
+
+    def filter(self, paths, counts, msgs):
+        """
+        Carry forward the rows of the prior run for paths with unchanged mtime, size and fingerprint
+
+        :param paths: iterable of paths
+        :param counts: dict of action counts, incremented for carried rows
+        :param msgs: dict of msg counts, incremented for carried rows
+        :return: generator of the paths that need to be read
+        """
+        from statcache import stat_stamp
+        for path in paths:
+            if self.prior is not None:
+                key = os.path.abspath(path)
+                rows = self.execute("SELECT mtime, size, lhd, action, msg FROM files WHERE run = ? AND path = ?", (self.prior, key))
+                try:
+                    stamp = stat_stamp(os.stat(path))
+                except OSError:
+                    stamp = None
+                pass
+                if len(rows) > 0 and tuple(rows[0][:2]) == stamp and rows[0][2] == self.fingerprint_of(path):
+                    action, msg = rows[0][3:]
+                    counts[action] = counts.get(action, 0) + 1
+                    msgs[msg] = msgs.get(msg, 0) + 1
+                    self.execute("INSERT OR REPLACE INTO files SELECT ?, %s FROM files WHERE run = ? AND path = ?" % ", ".join(self.columns), (self.run, self.prior, key))
+                    self.carried += 1
+                    self.nfiles += 1
+                    self._pending()
+                    continue
+                pass
+            pass
+            yield path
+        pass
+
+    def record(self, r):
+        """
+        :param r: process_path result with fingerprint, header text, mtime and size
+        """
+        if r["msg"] == "error": return
+        row = dict(r, path=os.path.abspath(r["path"]), lhd=self.fingerprint_of(r["path"]))
+        self.execute("INSERT OR REPLACE INTO files VALUES (?,%s)" % ",".join("?"*len(self.columns)), [self.run] + [row.get(k) for k in self.columns])
+        fp = r.get("fingerprint")
+        if fp is not None and not fp in self.headers:
+            self.headers.add(fp)
+            self.execute("INSERT OR IGNORE INTO headers VALUES (?,?)", (fp, r["header"]))
+        pass
+        self.nfiles += 1
+        self._pending()
+
+    def _pending(self):
+        with self.lock:
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+            pass
+        pass
+
+    def close(self):
+        """
+        mark the run complete and drop runs beyond keep, with their unreferenced headers
+        """
+        if self.run is not None:
+            self.execute("UPDATE runs SET complete = 1, nfiles = ? WHERE run = ?", (self.nfiles, self.run))
+            old = self.runs()[:-self.keep]
+            for run in old:
+                self.execute("DELETE FROM files WHERE run = ?", (run,))
+                self.execute("DELETE FROM runs WHERE run = ?", (run,))
+            pass
+            self.execute("DELETE FROM headers WHERE NOT fingerprint IN (SELECT DISTINCT fingerprint FROM files WHERE fingerprint IS NOT NULL)")
+            log.info("%r files %d carried forward %d " % (self, self.nfiles, self.carried))
+        pass
+        self.conn.commit()
+        self.conn.close()
+
+    def latest(self, n=1):
+        runs = self.runs()
+        if len(runs) < n:
+            raise LookupError("inventory %s has %d complete runs, %d needed " % (self.path, len(runs), n))
+        pass
+        return runs[-n]
+
+    def match(self, prefix):
+        """
+        :return fingerprint: the single one starting with prefix
+        """
+        fps = [fp for (fp,) in self.execute("SELECT fingerprint FROM headers WHERE fingerprint LIKE ?", (prefix + "%",))]
+        if len(fps) != 1:
+            raise LookupError("fingerprint prefix %s matches %d headers " % (prefix, len(fps)))
+        pass
+        return fps[0]
+
+    def clusters(self, msg=None, examples=3):
+        """
+        :param msg: optional restriction, eg has_other_license
+        :return list: of (count, fingerprint, msgs, first line, example paths), largest first
+        """
+        run = self.latest()
+        sql = "SELECT fingerprint, count(*), group_concat(DISTINCT msg) FROM files WHERE run = ? AND fingerprint IS NOT NULL"
+        params = [run]
+        if msg is not None:
+            sql += " AND msg = ?"
+            params.append(msg)
+        pass
+        out = []
+        for fp, count, msgs in self.execute(sql + " GROUP BY fingerprint ORDER BY count(*) DESC, fingerprint", params):
+            text = self.execute("SELECT text FROM headers WHERE fingerprint = ?", (fp,))[0][0]
+            paths = [p for (p,) in self.execute("SELECT path FROM files WHERE run = ? AND fingerprint = ? ORDER BY path LIMIT ?", (run, fp, examples))]
+            out.append((count, fp, msgs, text.split("\n")[0], paths))
+        pass
+        return out
+
+    def files(self, fingerprint):
+        return [p for (p,) in self.execute("SELECT path FROM files WHERE run = ? AND fingerprint = ? ORDER BY path", (self.latest(), fingerprint))]
+
+    def text(self, fingerprint):
+        return self.execute("SELECT text FROM headers WHERE fingerprint = ?", (fingerprint,))[0][0]
+
+    def diff(self):
+        """
+        :return list: of (change, path, before, after) between the previous and latest runs,
+                      change is one of added, removed, changed with before and after fingerprints
+        """
+        new, old = self.latest(1), self.latest(2)
+        sql = "SELECT a.path, a.fingerprint, b.path, b.fingerprint FROM files a LEFT JOIN files b ON b.run = ? AND b.path = a.path WHERE a.run = ?"
+        out = []
+        for path, fp, path0, fp0 in self.execute(sql, (old, new)):
+            if path0 is None:
+                out.append(("added", path, None, fp))
+            elif fp != fp0:
+                out.append(("changed", path, fp0, fp))
+            pass
+        pass
+        for path, fp0 in self.execute("SELECT path, fingerprint FROM files WHERE run = ? AND NOT path IN (SELECT path FROM files WHERE run = ?)", (old, new)):
+            out.append(("removed", path, fp0, None))
+        pass
+        return sorted(out, key=lambda c:(c[1], c[0]))
+
+    def __repr__(self):
+        return "Inventory %s run %s " % (self.path, self.run)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Query the header inventory written by licensehd.py --inventory")
+    parser.add_argument("query", choices=["clusters", "show", "files", "diff"], help="clusters: headers by number of files, show: text of a header, files: carrying a header, diff: since the previous inventory")
+    parser.add_argument("fingerprint", nargs="?", default=None, help="Fingerprint, or a unique prefix of one, for show and files")
+    parser.add_argument("--db", default=Inventory.name, help="Path of the inventory")
+    parser.add_argument("--msg", default=None, help="Restrict clusters to files with the msg, eg has_other_license")
+    parser.add_argument("--examples", type=int, default=3, help="Number of example paths per cluster")
+    parser.add_argument("--level", default="info", help="logging level")
+    opt = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, opt.level.upper()), format="%(message)s")
+
+    if not os.path.exists(opt.db):
+        log.fatal("no inventory at %s, create with licensehd.py --inventory " % opt.db)
+        return 2
+    pass
+    inv = Inventory(opt.db)
+    try:
+        if opt.query == "clusters":
+            for count, fp, msgs, first, paths in inv.clusters(opt.msg, opt.examples):
+                print("%7d %s %-30s %s" % (count, fp, msgs, first[:60]))
+                for path in paths:
+                    print("%7s %s" % ("", path))
+                pass
+            pass
+        elif opt.query == "diff":
+            for change, path, before, after in inv.diff():
+                print("%-8s %-16s %-16s %s" % (change, before or "-", after or "-", path))
+            pass
+        elif opt.fingerprint is None:
+            parser.error("%s requires a fingerprint" % opt.query)
+        else:
+            fp = inv.match(opt.fingerprint)
+            out = inv.text(fp).split("\n") if opt.query == "show" else inv.files(fp)
+            for line in out:
+                print(line)
+            pass
+        pass
+    except LookupError as err:
+        log.fatal(str(err))
+        return 2
+    finally:
+        inv.conn.close()
+    pass
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+journal.py
+============
+
+Transactional application of rewrites, for runs that may be interrupted
+by errors, Ctrl-C or a crash::
+
+    licensehd.py ~/opticks --update --transaction -j 8     # journal in ~/opticks/.licensehd.journal
+    licensehd.py ~/opticks --rollback                      # undo the last committed batch
+    licensehd.py ~/opticks --rollback                      # and the one before
+
+With --transaction the workers only stage each rewrite, into a temporary
+sibling file, passing back the byte offset of the original header end, the
+original head bytes and the hashes. The parent records them in the journal,
+a JSON Lines file, and applies them in batches of --fsync-batch files:
+
+1. one os.sync makes the data of all the staged files of the batch durable
+2. a "prepare" record is appended to the journal and fsync-ed
+3. the staged files are renamed over the originals
+4. the directories are fsync-ed and a "commit" record appended and fsync-ed
+
+So there is a single group sync per batch rather than one per file. As
+only the head of a file is changed the journal stays compact: a rewrite
+is undone by writing the original head followed by the current file
+beyond the new head, checked against the original hash.
+
+Opening the journal recovers from a previous run that did not end cleanly:
+batches that were prepared but not committed are completed and recorded as
+committed, as their staged data is durable. Staged files of batches that were
+not prepared are removed, leaving the originals untouched. An interrupted run
+does the same itself when it aborts, so a batch is either applied in full
+or not at all, and every applied batch can be rolled back. --rollback recovers
+first. Temporary files have the suffix .licensehd.tmp.
+
+Rewrites reach the StatCache only once their batch is committed, through
+the committed callback. A rollback gives the restored files a fresh mtime,
+and their cache rows are deleted.
+
+"""
+import os, sys, json, time, base64, hashlib, logging
+log = logging.getLogger(__name__)
+
+replace = getattr(os, "replace", os.rename)
+
+
+def file_sha1(path, skip=0, bufsize=1<<20):
+    """
+    :return (hexdigest, size): of the file beyond skip bytes
+    """
+    h = hashlib.sha1()
+    n = 0
+    with open(path, "rb") as f:
+        f.seek(skip)
+        while True:
+            buf = f.read(bufsize)
+            if not buf: break
+            h.update(buf)
+            n += len(buf)
+        pass
+    pass
+    return h.hexdigest(), n
+
+
+class Journal(object):
+    name = ".licensehd.journal"
+
+    @classmethod
+    def default_path(cls, args):
+        """
+        :return path: in the directory being processed, or the invoking directory
+        """
+        from statcache import StatCache
+        return os.path.join(StatCache.default_root(args), cls.name)
+
+    def __init__(self, path, batch=1000, committed=None):
+        """
+        :param path: of the journal
+        :param batch: number of rewrites per group commit
+        :param committed: optional callable, called with each result once its rewrite is committed
+        """
+        self.path = path
+        self.batch = batch
+        self.committed = committed
+        self.staged = []
+        self.results = []    # of the staged records, for the committed callback
+        self.prepared = False
+        self.nbatch = 0
+        self.ncommit = 0
+        self.folds = set()    # directories of the staged files
+        self.f = None
+
+    def records(self):
+        """
+        :return list: of the records in the journal, a truncated last line from a crash is ignored
+        """
+        if not os.path.exists(self.path): return []
+        recs = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    recs.append(json.loads(line))
+                except ValueError:
+                    log.warning("ignoring truncated journal record %r " % line[:50])
+                pass
+            pass
+        pass
+        return recs
+
+    def batches(self, recs):
+        """
+        :return list: of (batch, entries, states) in journal order
+        """
+        out = []
+        index = {}
+        for rec in recs:
+            b = rec.get("batch")
+            if b is None: continue
+            if not b in index:
+                index[b] = (b, [], set())
+                out.append(index[b])
+            pass
+            if rec["op"] == "stage":
+                index[b][1].append(rec)
+            else:
+                index[b][2].add(rec["op"])
+            pass
+        pass
+        return out
+
+    def append(self, rec, sync=False):
+        self.f.write(json.dumps(rec) + "\n")
+        if sync:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+        pass
+
+    def begin(self):
+        """
+        recover from an unclean previous run and start the journal afresh
+        """
+        self.recover()
+        self.f = open(self.path, "w")
+        self.append(dict(op="begin", time=time.time(), pid=os.getpid()), sync=True)
+
+    def recover(self):
+        """
+        Complete or discard the batches of a previous run that did not end cleanly, and 
+        sweep the directories of its staged files of leftover temporary files 
+        """
+        recs = self.records()
+        marks = [rec for rec in recs if rec["op"] in ("begin", "end")]
+        if len(marks) == 0 or (marks[-1]["op"] == "end" and not marks[-1].get("aborted")): return
+        from licensehd import fsync_dir
+        nforward, nremove = 0, 0
+        completed = []
+        for b, entries, states in self.batches(recs):
+            if "commit" in states: continue
+            for e in entries:
+                if "prepare" in states:
+                    if os.path.exists(e["tmp"]):
+                        replace(e["tmp"], e["path"])
+                        nforward += 1
+                    pass
+                elif os.path.exists(e["tmp"]):
+                    os.remove(e["tmp"])
+                    nremove += 1
+                pass
+            pass
+            if "prepare" in states:
+                completed.append((b, entries))
+            pass
+        pass
+        for fold in sorted(set(os.path.dirname(e["path"]) for b, entries in completed for e in entries)):
+            fsync_dir(fold)
+        pass
+        nremove += self.sweep(set(os.path.dirname(rec["path"]) for rec in recs if rec["op"] == "stage"))
+        log.warning("recovered journal %s of an interrupted run : completed %d prepared rewrites, removed %d staged files " % (self.path, nforward, nremove))
+        with open(self.path, "a") as f:
+            for b, entries in completed:
+                f.write(json.dumps(dict(op="commit", batch=b, n=len(entries), recovered=True)) + "\n")    # so they can be rolled back 
+            pass
+            f.write(json.dumps(dict(op="end", recovered=True)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        pass
+
+    def stage(self, r):
+        """
+        :param r: process_path result with the staged temporary file and undo, which is popped
+        """
+        undo = r["undo"]
+        rec = dict(op="stage", batch=self.nbatch, path=os.path.abspath(r["path"]), tmp=os.path.abspath(r["staged"]),
+                   offset=undo["offset"], head=base64.b64encode(undo["head"]).decode("ascii"),
+                   new_head_len=undo["new_head_len"], orig_hash=undo["orig_hash"], new_hash=undo["new_hash"])
+        self.staged.append(rec)    # before the write, so abort removes the staged file whenever interrupted
+        self.results.append(r)
+        self.folds.add(os.path.dirname(rec["path"]))
+        self.append(rec)    # written ahead, so the staged file can be removed when interrupted before the prepare
+        del r["undo"], r["staged"]
+        if len(self.staged) >= self.batch:
+            self.commit()
+        pass
+
+    def commit(self):
+        """
+        group commit of the staged rewrites
+        """
+        if len(self.staged) == 0: return
+        if hasattr(os, "sync"):
+            os.sync()
+        pass
+        self.append(dict(op="prepare", batch=self.nbatch), sync=True)
+        self.prepared = True
+        self.apply()
+
+    def apply(self):
+        """
+        rename the staged files of the prepared batch over their originals and record the 
+        commit, skipping those already renamed when completing an interrupted apply
+        """
+        from licensehd import fsync_dir
+        b = self.nbatch
+        folds = set()
+        for rec in self.staged:
+            if os.path.exists(rec["tmp"]):
+                replace(rec["tmp"], rec["path"])
+            pass
+            folds.add(os.path.dirname(rec["path"]))
+        pass
+        for fold in sorted(folds):
+            fsync_dir(fold)
+        pass
+        self.append(dict(op="commit", batch=b, n=len(self.staged)), sync=True)
+        self.prepared = False
+        log.debug("Journal committed batch %d of %d files " % (b, len(self.staged)))
+        self.ncommit += len(self.staged)
+        results = self.results
+        self.staged = []
+        self.results = []
+        self.nbatch += 1
+        if self.committed is not None:
+            for r in results:
+                self.committed(r)
+            pass
+        pass
+
+    def end(self):
+        self.commit()
+        self.append(dict(op="end"), sync=True)
+        self.f.close()
+        log.info("%r committed %d rewrites in %d batches " % (self, self.ncommit, self.nbatch))
+
+    def discard(self, r):
+        """
+        :param r: process_path result not journaled, its staged file is removed
+        """
+        r.pop("undo", None)
+        tmp = r.pop("staged", None)
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+        pass
+
+    def sweep(self, folds):
+        """
+        :param folds: directories 
+        :return n: number of leftover temporary files removed from the directories
+        """
+        from licensehd import TMP_SUFFIX
+        n = 0
+        for fold in sorted(folds):
+            try:
+                names = os.listdir(fold)
+            except OSError:
+                continue
+            pass
+            for name in names:
+                if name.startswith(".") and name.endswith(TMP_SUFFIX):
+                    try:
+                        os.remove(os.path.join(fold, name))
+                        n += 1
+                    except OSError:
+                        pass
+                    pass
+                pass
+            pass
+        pass
+        return n
+
+    def abort(self):
+        """
+        Complete a batch interrupted after its prepare, as some of its files may already be
+        renamed. Otherwise remove the staged files of the open batch, leaving their originals 
+        untouched, and any other leftover temporary files in the directories of the staged files.
+        When the completion fails the staged files are left for recover.
+        """
+        if self.prepared:
+            try:
+                self.apply()
+            except (IOError, OSError) as err:
+                log.fatal("%r failed to complete prepared batch %d, left for recovery by the next run : %s " % (self, self.nbatch, err))
+                self.f.close()    # without the end record, so the next run recovers 
+                return
+            pass
+        pass
+        for rec in self.staged:
+            if os.path.exists(rec["tmp"]):
+                os.remove(rec["tmp"])
+            pass
+        pass
+        nswept = self.sweep(self.folds)
+        log.warning("%r aborted, discarded %d staged rewrites and %d leftover files, %d committed " % (self, len(self.staged), nswept, self.ncommit))
+        self.append(dict(op="end", aborted=True), sync=True)
+        self.f.close()
+
+    def rollback(self):
+        """
+        Undo the last committed batch not already rolled back, after recovering an
+        interrupted run. Files changed since the rewrite, whose hash no longer matches, 
+        are left alone with a warning. Restored files keep their mode but get a fresh
+        mtime, as their content changes.
+
+        :return (restored, nskip): paths of the restored files and the number skipped
+        """
+        import tempfile
+        from shutil import copymode
+        from licensehd import fsync_dir, TMP_SUFFIX
+        self.recover()
+        recs = self.records()
+        done = set(rec["batch"] for rec in recs if rec["op"] == "rollback")
+        committed = [(b, entries) for b, entries, states in self.batches(recs) if "commit" in states and not b in done]
+        if len(committed) == 0:
+            raise LookupError("journal %s has no committed batch to roll back " % self.path)
+        pass
+        b, entries = committed[-1]
+        restored, nskip = [], 0
+        folds = set()
+        for e in reversed(entries):
+            path = e["path"]
+            if not os.path.exists(path) or file_sha1(path)[0] != e["new_hash"]:
+                log.warning("not rolling back %s as changed since the rewrite " % path)
+                nskip += 1
+                continue
+            pass
+            fold = os.path.dirname(path)
+            fd, ptmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(path), suffix=TMP_SUFFIX, dir=fold)
+            os.close(fd)
+            ok = False
+            try:
+                h = hashlib.sha1()
+                with open(ptmp, "wb") as fw, open(path, "rb") as f:
+                    head = base64.b64decode(e["head"])
+                    fw.write(head)
+                    h.update(head)
+                    f.seek(e["new_head_len"])
+                    while True:
+                        buf = f.read(1 << 16)
+                        if not buf: break
+                        fw.write(buf)
+                        h.update(buf)
+                    pass
+                pass
+                if h.hexdigest() != e["orig_hash"]:
+                    log.fatal("rollback of %s would not reproduce the original, skipped " % path)
+                    nskip += 1
+                    continue
+                pass
+                copymode(path, ptmp)
+                replace(ptmp, path)
+                folds.add(fold)
+                ok = True
+                restored.append(path)
+            finally:
+                if not ok and os.path.exists(ptmp):
+                    os.remove(ptmp)
+                pass
+            pass
+        pass
+        if hasattr(os, "sync"):
+            os.sync()
+        pass
+        for fold in sorted(folds):
+            fsync_dir(fold)
+        pass
+        with open(self.path, "a") as f:
+            f.write(json.dumps(dict(op="rollback", batch=b, n=len(restored), skipped=nskip)) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        pass
+        log.info("%r rolled back batch %d : %d files restored %d skipped " % (self, b, len(restored), nskip))
+        return restored, nskip
+
+    def __repr__(self):
+        return "Journal %s " % self.path
@@ -24,13 +24,16 @@ Python coding directives need to be on 1st or 2nd line ?
 
 
 """
-import logging, os, sys, argparse, fnmatch
+import logging, os, sys, io, codecs
 log = logging.getLogger(__name__)
 
-from string import Template
-from shutil import copyfile, copymode, copystat
 from collections import OrderedDict as odict 
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir   # py2 backport 
+
 # import regex as re
 # regex is a third party external, which apparently handles encodings better 
 # than standard re but it seems to not be necessary in my usage 
@@ -41,9 +44,25 @@ import re
 from py2open import open
 from filetypes import FileTypes
 
+# Startup is kept fast by importing modules only needed by some code paths
+# (argparse, fnmatch, multiprocessing, tempfile, shutil, json, string and the 
+# local statcache, gitpaths and runstats) within the functions that use them.
+# Check with: python -X importtime -c "import licensehd" or bench.py --files 0 --startup-budget-ms 80
+
 FT = FileTypes()
 
-emptyPattern = re.compile(r'^\s*$')
+replace = getattr(os, "replace", os.rename)   # py2 lacks os.replace, os.rename is atomic on POSIX
+
+PRUNE_DIRS = set([".git", ".hg", ".svn", "__pycache__", "node_modules", ".tox", ".venv"])
+
+ESCAPE = "surrogateescape" if sys.version_info[0] > 2 else "strict"   # error handler for str carrying undecodable bytes 
+
+BOMS = [(codecs.BOM_UTF32_LE, "utf-32"), (codecs.BOM_UTF32_BE, "utf-32"), (codecs.BOM_UTF8, "utf-8"), 
+        (codecs.BOM_UTF16_LE, "utf-16"), (codecs.BOM_UTF16_BE, "utf-16")]   # UTF-32 first, as BOM_UTF32_LE starts with BOM_UTF16_LE
+
+TMP_SUFFIX = ".licensehd.tmp"
+
+REPR_FMT = " sk:%(skip)1d cpl:%(copyrightLine)2d  ocpl:%(otherCopyrightLine)2d  hs:%(headStart)2d he:%(headEnd)2d : %(msg)-20s :  %(path)-30s     "
 
         
 class CopyrightLine(object):
@@ -57,7 +76,7 @@ class CopyrightLine(object):
     pattern = re.compile("(?P<pre>.*?)(?P<yrs>[0-9]{4}(?:-[0-9][0-9]?[0-9]?[0-9]?)?)(?P<post>.*)$")
 
     def __init__(self, header):
-        lines = filter( lambda l:l.find("Copyright") > -1, header )
+        lines = list(filter( lambda l:l.find("Copyright") > -1, header ))
         assert len(lines) > 0 
         line = lines[0] 
         m = self.pattern.match(line)
@@ -73,21 +92,180 @@ class CopyrightLine(object):
                
 
 
+class HeaderScanner(object):
+    """
+    Single pass classification of the lines of the header window for one 
+    file type, compiled once per type and memoized along with the rendered header.
+
+    Leading lines are classified by one search of an alternation of named groups, 
+    in order of precedence::
+
+        (?P<keep>keepFirst)|(?P<empty>^\s*$)|(?P<block>blockCommentStart)|(?P<line>lineCommentStart)
+
+    As all but the line comment start are anchored at the start of the line 
+    the leftmost match is also the highest precedence one. The keep alternative 
+    is only included while at the first line or following kept lines. 
+
+    Once the header start is found the remaining lines are scanned, testing 
+    for "Copyright" before trying the CopyrightLine match, and with a single 
+    search for the line comment start per line. 
+    """
+    def __init__(self, settings, copyrightline):
+        alts = [("empty", r"^\s*$")]
+        for name, ptn in [("block", settings.blockCommentStartPattern), ("line", settings.lineCommentStartPattern)]:
+            if ptn is not None:
+                alts.append((name, ptn.pattern))
+            pass
+        pass
+        self.start = self.alternation(alts)
+        keep = settings.keepFirst
+        self.start_keep = self.start if keep is None else self.alternation([("keep", keep.pattern)] + alts)
+        self.block_end = settings.blockCommentEndPattern
+        self.line_comment = settings.lineCommentStartPattern
+        self.copyrightline = copyrightline
+
+    @classmethod
+    def alternation(cls, alts):
+        return re.compile("|".join(["(?P<%s>%s)" % (name, ptn) for name, ptn in alts]))
+
+    def scan(self, lines, d):
+        """
+        :param lines: header window
+        :param d: LicenseHD dict updated with skip, comment, headStart, headEnd, copyrightLine, otherCopyrightLine
+        """
+        debug = log.isEnabledFor(logging.DEBUG)
+        kind = None
+        i = 0 
+        n = len(lines)
+        while i < n:
+            start = self.start_keep if (i == 0 or d["skip"] > 0) else self.start
+            m = start.search(lines[i])
+            kind = None if m is None else m.lastgroup
+            if debug:
+                log.debug(" i %d skip %d kind %s line [%s] " % (i, d["skip"], kind, lines[i]))
+            pass
+            if kind == "keep":
+                d["skip"] = i + 1
+            elif kind != "empty":
+                break
+            pass
+            i += 1
+        pass
+        if kind == "block" or kind == "line":
+            d["comment"] = kind
+            d["headStart"] = i
+            if kind == "block":
+                self.scan_block(lines, i, d)
+            else:
+                self.scan_line(lines, i, d)
+            pass
+        pass
+        if debug:
+            log.debug("   i:%d lines:%d skip:%d headStart:%d headEnd:%d comment:%s " % (i, n, d["skip"], d["headStart"], d["headEnd"], d["comment"]))
+        pass
+
+    def scan_block(self, lines, i, d):
+        matches = self.copyrightline.matches
+        end_blank = LicenseTmpl.end_blank
+        for j in range(i, len(lines)):
+            line = lines[j]
+            if "Copyright" in line:
+                if matches(line):
+                    d["copyrightLine"] = j
+                else:
+                    d["otherCopyrightLine"] = j
+                pass
+            elif end_blank:
+                if not line.strip():
+                    d["headEnd"] = j
+                    break
+                pass
+            elif self.block_end.search(line):
+                d["headEnd"] = j
+                break
+            pass
+        pass
+
+    def scan_line(self, lines, i, d):
+        """
+        When using LicenseTmpl.end_blank the blank line must be
+        treated as a part of header to avoid file growing by a blank line
+        on each update. 
+        """  
+        matches = self.copyrightline.matches
+        search = self.line_comment.search
+        end_blank = LicenseTmpl.end_blank
+        for j in range(i, len(lines)):
+            line = lines[j]
+            comment = search(line) is not None
+            if "Copyright" in line:
+                if comment and matches(line):
+                    d["copyrightLine"] = j
+                else:
+                    d["otherCopyrightLine"] = j
+                pass
+            elif not comment:
+                d["headEnd"] = j if end_blank else j - 1  
+                break
+            pass
+        pass
+        # hmm : below seems an arbitrary setting of headEnd depending on the headlines
+        if d["headEnd"] == -1:
+            d["headEnd"] = len(lines) - 1  
+        pass
+
+
 class LicenseTmpl(object):
+    """
+    The header for each file type and year range is rendered once, on first use, 
+    and memoized in self.rendered together with its CopyrightLine matcher.
+    """
     end_blank = True
     def __init__(self, path, args):
         with open(path, 'r') as f:
             lines = f.readlines()
         pass
-        lines = [Template(line).substitute(args.d) for line in lines]
-        self.lines = lines 
+        self.raw = lines
+        self.d = args.d
+        self.lines = self.substitute(self.d["years"])
+        self.rendered = {}
+
+    def substitute(self, years):
+        from string import Template
+        d = dict(self.d, years=years)
+        return [Template(line).substitute(d) for line in self.raw]
 
     def __call__(self, path):
         """
         :return template lines formatted for type of the path:
         """
+        return list(self.header(FT(path).ftype)[0])
+
+    def header(self, ftype, years=None):
+        """
+        :param ftype: file type key of FileTypes.typeSettings
+        :param years: year range string, when None the args.years default is used 
+        :return (lines, copyrightline, scanner): tuple of rendered header lines, CopyrightLine and HeaderScanner
+        """
+        key = (ftype, years)
+        rendered = self.rendered.get(key)
+        if rendered is None:
+            settings = FT.types[ftype]
+            tlines = self.lines if years is None else self.substitute(years)
+            lines = tuple(self.render(settings, tlines))
+            copyrightline = CopyrightLine(lines)
+            rendered = (lines, copyrightline, HeaderScanner(settings, copyrightline))
+            self.rendered[key] = rendered
+        pass
+        return rendered
+
+    def render(self, settings, tlines):
+        """
+        :param settings: FileTypes settings for the type 
+        :param tlines: substituted template lines
+        :return lines: template lines with the comment decoration of the type
+        """
         lines = []
-        settings = FT(path)
         header_start_line = settings["headerStartLine"]
         header_end_line = settings["headerEndLine"]
         header_line_prefix = settings["headerLinePrefix"]
@@ -96,7 +274,7 @@ class LicenseTmpl(object):
 
         if header_start_line is not None:
             lines.append(header_start_line)
-        for line in self.lines:
+        for line in tlines:
             tmp = line
             if header_line_prefix is not None and line == '\n':
                 tmp = header_line_prefix.rstrip() + tmp
@@ -120,36 +298,101 @@ class LicenseTmpl(object):
         return "".join(self.lines) 
 
 
+def sniff_bytes(prefix):
+    """
+    :param prefix: first bytes of a file
+    :return (binary, bom): binary is "wide_encoding" for a UTF-16 or UTF-32 BOM, "binary"
+             when there are NUL bytes, otherwise None. bom is the UTF-8 BOM when present, otherwise b""
+    """
+    for bom, enc in BOMS:
+        if prefix.startswith(bom):
+            return (None, bom) if enc == "utf-8" else ("wide_encoding", b"")
+        pass
+    pass
+    return ("binary" if b"\0" in prefix else None), b""
+
+
 class LicenseHD(object):
+    """
+    Only the first headlines of the file are read on construction, which is 
+    all that parse_head needs to classify the file. The window is read as bytes, 
+    each line limited to maxline, and decoded with CRLF translated for the 
+    parse, keeping the byte offset of the first line following the header. 
+    The body beyond that offset is never decoded: a rewrite copies it from 
+    source to destination in chunks of bufsize bytes, so memory use is 
+    bounded irrespective of the size of the file.  
+
+    Before any decoding a prefix of sniffsize bytes is checked by sniff_bytes. 
+    Binary files, and those in UTF-16 or UTF-32, are left alone with msg "binary" 
+    or "wide_encoding". A UTF-8 BOM is kept and the file decoded as UTF-8. The lines 
+    preceding the header are written back byte for byte, and the header with the 
+    line ending of the first line, so CRLF files are preserved.  
+
+    When text is given, as str or bytes, it is used in place of the content 
+    of the file at path, which then only serves as a name, see apply_header.
+    The text can also be a binary file object, such as the HeadBuffer over 
+    an archive member of archive.py. 
+    """
     headlines = 30
+    maxline = 1 << 16 
+    bufsize = 1 << 16 
+    sniffsize = 1 << 13 
 
-    def __init__(self, path, args):
+    def __init__(self, path, args, text=None, ftype=None):
         self.path = path
-        self.ptmp = "%s.tmp" % path
         self.args = args
+        self.text = text
+        self.stats = odict() if args.stats else None
 
-        header = args.template(path)  # header text customized to file type
-        copyrightline = CopyrightLine(header)
+        settings = FT(path) if ftype is None else FT.types.get(ftype)   # shared immutable TypeSettings 
+        assert settings is not None, "unrecognized file type %s %s " % (path, ftype)
+
+        years = None
+        if args.years_index is not None:
+            yrs = args.years_index.get(os.path.realpath(path)) 
+            years = None if yrs is None else "%d-%d" % yrs    # files without history get the args.years default
+        pass
+        configs = getattr(args, "configs", None)
+        template = args.template if configs is None else configs.template(path)   # shared by directories with the same .licensehd settings 
+        header, copyrightline, scanner = template.header(settings.ftype, years)  # memoized per file type and years
 
         self.copyrightline = copyrightline
         self.header = header 
+        self.scanner = scanner
 
-        settings = FT(path)
-
-        self.keep_first = settings.get("keepFirst")
-        self.block_comment_start_pattern = settings.get("blockCommentStartPattern")
-        self.block_comment_end_pattern = settings.get("blockCommentEndPattern")
-        self.line_comment_start_pattern = settings.get("lineCommentStartPattern")
-
-        log.debug("\n".join(["settings"] + ["%25s : %r " % (kv[0], kv[1]) for kv in settings.items() ]))
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("\n".join(["settings"] + ["%25s : %r " % (kv[0], kv[1]) for kv in settings.items() ]))
+        pass
 
-        with open(path, 'r', encoding=args.encoding) as f:
-            self.lines = f.readlines()
+        if self.stats is not None:
+            from runstats import timer, cpu
+            t0, c0 = timer(), cpu()
+        pass
+        with self.open_source() as f:
+            prefix = f.read(self.sniffsize)
+            self.binary, self.bom = sniff_bytes(prefix)
+            raw = []
+            if self.binary is None:
+                f.seek(len(self.bom))
+                for _ in range(self.headlines):     # header window only 
+                    line = f.readline(self.maxline)
+                    if not line: break
+                    raw.append(line)
+                pass
+            pass
+        pass
+        self.encoding = "utf-8" if self.bom else args.encoding
+        self.newline = "\r\n" if len(raw) > 0 and raw[0].endswith(b"\r\n") else "\n"
+        self.lines = [self.decode(line) for line in raw]    # UnicodeDecodeError for content not in the encoding  
+        if self.stats is not None:
+            self.stats["read"], self.stats["read_cpu"] = timer() - t0, cpu() - c0
+            self.stats["bytes_read"] = len(prefix) if self.binary else sum(len(line) for line in raw)
+            t0, c0 = timer(), cpu()
         pass
 
         d = odict()
         d["path"] = path
-        d["ftype"] = settings["ftype"]
+        d["ftype"] = settings.ftype
         d["settings"] = settings
 
         d["skip"] = 0 
@@ -161,6 +404,9 @@ class LicenseHD(object):
 
         self.parse_head(d)  
         self.d = d 
+        if self.stats is not None:
+            self.stats["parse"], self.stats["parse_cpu"] = timer() - t0, cpu() - c0
+        pass
 
         has_header = d["headStart"] > -1 and d["headEnd"] > -1
         has_license = has_header and d["copyrightLine"] > -1 
@@ -174,118 +420,106 @@ class LicenseHD(object):
 
 
         if has_header:
-            _header = self.lines[d["headStart"]:d["headEnd"]+1]   
+            _header = tuple(self.lines[d["headStart"]:d["headEnd"]+1])
         else:
             _header = None
         pass
         self._header = _header      
 
+        self.uptodate = has_license and _header == header   # existing header identical to the rendered one
+        self.d["uptodate"] = self.uptodate
+
         if self.has_license:
+            cut = self.d["headEnd"]+1
             prehead = self.lines[0:self.d["headStart"]] 
-            posthead = self.lines[self.d["headEnd"]+1:]
         else:
+            cut = self.d["skip"]
             prehead = self.lines[0:self.d["skip"]]
-            posthead = self.lines[self.d["skip"]:]
         pass 
 
-        #print("prehead\n" + "".join(prehead) )
-        #print("posthead\n" + "".join(posthead) )
-
         self.prehead = prehead
-        self.posthead = posthead
-
+        self.raw_prehead = raw[0:len(prehead)]
+        self.cut = cut     # index of the first line following the header 
+        self.raw_head = self.bom + b"".join(raw[:cut])    # original bytes preceding the cut 
+        self.offset = len(self.raw_head)   # byte offset of the cut 
 
-    def parse_head(self, d):
-        rlines = self.lines[:self.headlines] 
-        i = 0
-        for line in rlines:
-            log.debug(" i %d skip %d  line [%s]  " % ( i, d["skip"], line ))
-
-            if (i == 0 or d["skip"] > 0) and self.keep_first and self.keep_first.findall(line):
-                d["skip"] = i + 1      
-                log.debug(" keep_first skip line [%s] " % line )
-            elif emptyPattern.findall(line):
-                pass
-            elif self.block_comment_start_pattern and self.block_comment_start_pattern.findall(line):
-                d["comment"] = "block" 
-                d["headStart"] = i
-                break
-            elif self.line_comment_start_pattern and self.line_comment_start_pattern.findall(line):
-                d["comment"] = "line" 
-                d["headStart"] = i
-                break
-            elif not self.block_comment_start_pattern and self.line_comment_start_pattern and self.line_comment_start_pattern.findall(line):
-                d["comment"] = "line" 
-                d["headStart"] = i
-                break
-            else:
-                break 
-            pass
-            i = i + 1
+    def decode(self, line):
+        """
+        :param line: bytes of one line of the header window
+        :return str: with a CRLF line ending translated to LF 
+        """
+        line = line.decode(self.encoding)
+        if line.endswith("\r\n"):
+            line = line[:-2] + "\n"
         pass
+        return line 
 
-        log.debug("   i:%d rlines:%d skip:%d headStart:%d comment:%s " % ( i, len(rlines), d["skip"], d["headStart"], d["comment"] ))
+    def open_source(self):
+        """
+        :return f: binary file object for the path, or over the in memory text 
+        """
+        if hasattr(self.text, "read"):
+            return self.text
+        elif self.text is not None:
+            return io.BytesIO(self.text if isinstance(self.text, bytes) else self.text.encode(self.args.encoding, ESCAPE))
+        pass
+        return open(self.path, 'rb')
 
-        if d["headStart"] > -1:
-            if d["comment"] == "block":
-                self.parse_block_comment(d, i, rlines)    
-            elif d["comment"] == "line":
-                self.parse_line_comment(d, i, rlines)    
-            pass
+    def head_bytes(self):
+        """
+        :return bytes: BOM, the original prehead bytes and the header with the line endings of the file  
+        """
+        header = "".join(self.header)
+        if self.newline != "\n":
+            header = header.replace("\n", self.newline)
         pass
+        return self.bom + b"".join(self.raw_prehead) + header.encode(self.encoding)
 
-    def parse_block_comment(self, d, i, rlines):
-        for j in range(i, len(rlines)):
-            line = rlines[j]  
-            if self.copyrightline.matches(line):
-                d["copyrightLine"] = j
-            elif line.find("Copyright") > -1:
-                d["otherCopyrightLine"] = j
-            elif self.block_comment_end_pattern.findall(line) and LicenseTmpl.end_blank == False:
-                d["headEnd"] = j 
-                log.debug("found block_comment pattern-end headEnd %d " % d["headEnd"])
-                break  
-            elif emptyPattern.findall(line) and LicenseTmpl.end_blank == True:
-                d["headEnd"] = j 
-                log.debug("found block_comment empty-end  headEnd %d " % d["headEnd"])
-                break  
-            pass 
-        pass  
+    def copy_posthead(self, fw, hashes=()):
+        """
+        Copy the bytes following the header to fw in chunks of bufsize
 
-    def parse_line_comment(self, d, i, rlines):
+        :param fw: binary file object
+        :param hashes: updated with each chunk
+        :return nbytes: copied
         """
-        When using LicenseTmpl.end_blank the blank line must be
-        treated as a part of header to avoid file growing by a blank line
-        on each update. 
-        """  
-        if not self.line_comment_start_pattern: return
-        for j in range(i, len(rlines)):
-            line = rlines[j]  
-            log.debug(line)
-
-            if self.line_comment_start_pattern.findall(line) and self.copyrightline.matches(line):
-                d["copyrightLine"] = j
-            elif line.find("Copyright") > -1:
-                d["otherCopyrightLine"] = j
-            elif not self.line_comment_start_pattern.findall(line):
-                d["headEnd"] = j if LicenseTmpl.end_blank else j - 1  
-                log.debug("found line_comment headEnd %d with line [%s] " % (d["headEnd"], line) )
-                break
-            pass 
-        pass
-        # hmm : below seems an arbitrary setting of headEnd depending on the headlines
-        if d["headEnd"] == -1:
-            d["headEnd"] = len(rlines) - 1  
+        n = 0 
+        with self.open_source() as f:
+            f.seek(self.offset)
+            while True:
+                buf = f.read(self.bufsize)
+                if not buf: break
+                fw.write(buf)
+                for h in hashes:
+                    h.update(buf)
+                pass
+                n += len(buf)
+            pass
         pass
+        return n 
+
+
+    def parse_head(self, d):
+        self.scanner.scan(self.lines, d)
 
     def __str__(self):
         return "\n".join(["%20s : %s " % (kv[0], kv[1]) for kv in self.d.items() ]) 
 
     def __repr__(self):
-        return " sk:%(skip)1d cpl:%(copyrightLine)2d  ocpl:%(otherCopyrightLine)2d  hs:%(headStart)2d he:%(headEnd)2d : %(msg)-20s :  %(path)-30s     " % self.d 
+        return REPR_FMT % self.d 
+
+    def result(self):
+        """
+        :return odict: picklable copy of the parse dict, without the settings, for passing back from workers 
+        """
+        r = odict((k, v) for k, v in self.d.items() if k != "settings")
+        r["written"] = False
+        return r 
 
     def _get_msg(self):
-        if self.has_other_license:
+        if self.binary is not None:
+            msg = self.binary
+        elif self.has_other_license:
             msg = "has_other_license"
         elif self.has_license:
             msg = "has_license"
@@ -295,78 +529,364 @@ class LicenseHD(object):
         return msg 
     msg = property(_get_msg)
 
-    def write_tmp(self):
-        assert os.path.exists(self.path)
-        with open(self.ptmp, 'w', encoding=self.args.encoding) as fw:
-            fw.writelines(self.prehead)
-            fw.writelines(self.header)
-            fw.writelines(self.posthead)
-        pass
-        copystat( self.path, self.ptmp )     
-
-    def check_tmp(self):
+    def check_counts(self):
         """
-        sanity check that the processing does not loose bits of the file
+        sanity check that the processing does not loose bits of the file, 
+        done before writing anything. As the bytes following the header are 
+        copied unchanged only the lines up to the cut need to be compared.  
         """
-        chk0 = open(self.path, "r").readlines()
-        chk  = open(self.ptmp, "r").readlines()
+        nchk0 = self.cut 
+        nchk = len(self.prehead) + sum(line.count("\n") for line in self.header) 
 
-        if self.has_license and len(chk) != len(chk0):
-            log.fatal("has_license update would have unexpectedly changed file length %s %s %d %d " % (self.path, self.ptmp, len(chk), len(chk0) ))
+        if self.has_license and nchk != nchk0:
+            log.fatal("has_license update would have unexpectedly changed file length %s %d %d " % (self.path, nchk, nchk0 ))
             return False  
         pass
-        if len(chk) < len(chk0):
-            log.fatal("write would have decreased file length  %s %s %d %d " % (self.path, self.ptmp, len(chk), len(chk0) ))
+        if nchk < nchk0:
+            log.fatal("write would have decreased file length  %s %d %d " % (self.path, nchk, nchk0 ))
             return False  
         pass
         return True 
 
-    def adopt_tmp(self):
-        p = self.path
-        ptmp = self.ptmp
+    def rewrite_bytes(self):
+        """
+        In memory counterpart of write 
 
-        if os.path.isfile(p):
-            os.remove(p) 
+        :return data: bytes with the header inserted or replaced, or None when check_counts vetoed the update 
+        """
+        if not self.check_counts(): 
+            return None
+        pass
+        fw = io.BytesIO()
+        fw.write(self.head_bytes())
+        self.copy_posthead(fw)
+        return fw.getvalue()
+
+    def stage(self):
+        """
+        Single pass rewrite into a temporary file in the same directory: prehead, 
+        header and the posthead bytes copied in chunks, hashing the original and 
+        the new content on the way. The file at path is left untouched. 
+
+        :return (ptmp, stamp, undo): or None when check_counts vetoed the update. 
+            stamp has the mtime, size and hash the file will have once ptmp is renamed over it 
+            and undo the byte offset and original head bytes with the original hash, 
+            which together with the length of the new head allow the rewrite to be reverted 
+        """
+        import tempfile, hashlib
+        from shutil import copystat
+        assert os.path.exists(self.path)
+        if not self.check_counts():
+            return None
+        pass
+        if self.stats is not None:
+            from runstats import timer, cpu
+            t0, c0 = timer(), cpu()
+        pass
+        fold = os.path.dirname(self.path) or "."
+        fd, ptmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(self.path), suffix=TMP_SUFFIX, dir=fold)
+        os.close(fd)
+        ok = False 
+        try:
+            raw_head = self.raw_head
+            head = self.head_bytes()
+            h0, h1 = hashlib.sha1(raw_head), hashlib.sha1(head)
+            with open(ptmp, 'wb') as fw:
+                fw.write(head)
+                npost = self.copy_posthead(fw, (h0, h1))
+                if self.args.fsync == "file":
+                    fw.flush()
+                    os.fsync(fw.fileno())
+                pass
+            pass
+            copystat(self.path, ptmp)
+            from statcache import stat_stamp
+            mtime, size = stat_stamp(os.stat(ptmp))
+            ok = True 
+        finally:
+            if not ok and os.path.exists(ptmp):
+                os.remove(ptmp)
+            pass
         pass
-        copyfile( ptmp, p )
-        copystat( ptmp, p )
-  
-        if os.path.isfile(ptmp):
-            os.remove(ptmp) 
+        if self.stats is not None:
+            self.stats["bytes_read"] = self.offset + npost
+            self.stats["bytes_written"] = len(head) + npost
+            self.stats["write"], self.stats["write_cpu"] = timer() - t0, cpu() - c0
         pass
+        stamp = dict(mtime=mtime, size=size, hash=h1.hexdigest())
+        undo = dict(offset=len(raw_head), head=raw_head, new_head_len=len(head), orig_hash=h0.hexdigest(), new_hash=stamp["hash"])
+        return ptmp, stamp, undo
 
     def write(self):
         """
+        The staged rewrite is atomically renamed over the original, so there 
+        is never a moment without the file. With args.fsync "file" the data and 
+        directory are synced before and after the rename, with "batch" syncing 
+        is left to BatchSync. See journal.py for the transactional alternative. 
+
+        :return stamp: of the rewritten file, or None when check_counts vetoed the update 
+        """
+        staged = self.stage()
+        if staged is None: 
+            return None
+        pass
+        ptmp, stamp, undo = staged
+        try:
+            replace(ptmp, self.path)
+        except OSError:
+            os.remove(ptmp)
+            raise
+        pass
+        if self.args.fsync == "file":
+            fsync_dir(os.path.dirname(self.path) or ".")
+        pass
+        return stamp
+
+
+def fsync_dir(fold):
+    """
+    sync a directory, making renames within it durable, where the platform allows 
+    """
+    try:
+        fd = os.open(fold, os.O_RDONLY)
+    except OSError:
+        return 
+    pass
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+    pass
+
+
+class BatchSync(object):
+    """
+    Group commit of rewritten files: rather than an fsync per file, after every 
+    batch of rewrites one os.sync flushes all the data followed by an fsync of 
+    each directory touched, to make the renames durable.  
+    """
+    def __init__(self, batch=1000):
+        self.batch = batch
+        self.folds = set()
+        self.count = 0 
+
+    def add(self, path):
+        self.folds.add(os.path.dirname(path) or ".")
+        self.count += 1 
+        if self.count >= self.batch:
+            self.flush()
+        pass
+
+    def flush(self):
+        if self.count == 0: return 
+        if hasattr(os, "sync"):
+            os.sync()
+        pass
+        for fold in sorted(self.folds):
+            fsync_dir(fold)
+        pass
+        log.debug("BatchSync flushed %d files in %d dirs " % (self.count, len(self.folds)))
+        self.folds = set()
+        self.count = 0 
+
+
+class GitIgnore(object):
+    """
+    Rules from a single .gitignore file, applying to paths beneath its directory. 
+    Handles the commonly used subset of the syntax: comments, "!" negation, 
+    trailing "/" for directory only rules and anchoring of rules that contain a "/".
+    """
+    name = ".gitignore"
+
+    @classmethod
+    def load(cls, base):
+        path = os.path.join(base, cls.name)
+        if not os.path.isfile(path):
+            return None
+        pass
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            lines = f.readlines()
+        pass
+        gi = cls(base, lines)
+        return gi if len(gi.rules) > 0 else None
+
+    def __init__(self, base, lines):
+        import fnmatch
+        self.base = base
+        self.rules = []
+        for line in lines:
+            line = line.rstrip()
+            if not line or line.startswith("#"): continue
+            negate = line.startswith("!")
+            if negate: 
+                line = line[1:]
+            pass
+            dironly = line.endswith("/")
+            line = line.rstrip("/")
+            anchored = "/" in line
+            line = line.lstrip("/")
+            if not line: continue
+            ptn = re.compile(fnmatch.translate(line))
+            self.rules.append((ptn, negate, dironly, anchored))
+        pass
+
+    def __call__(self, path, name, isdir):
+        """
+        :return: True when ignored, False when re-included by a negation, None when no rule matches
         """
-        self.write_tmp() 
-        ok = self.check_tmp() 
-        if not ok: return
-        self.adopt_tmp()
+        rel = path[len(self.base)+1:]
+        ignored = None
+        for ptn, negate, dironly, anchored in self.rules:
+            if dironly and not isdir: continue
+            if ptn.match(rel if anchored else name):
+                ignored = not negate 
+            pass
+        pass
+        return ignored
+
+    def __repr__(self):
+        return "GitIgnore %s rules %d " % (self.base, len(self.rules))
 
 
-def get_paths(fnpatterns, start_dir="."):
+def is_excluded(path, name, isdir, excludes, ignores):
+    """
+    :param excludes: list of glob patterns matched against the name and the path 
+    :param ignores: list of GitIgnore from the walk root down to the directory of the path
     """
-    Retrieve files that match any of the glob patterns from the start_dir and below.
-    :param fnpatterns: the file name patterns
+    import fnmatch
+    for pattern in excludes:
+        if fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(path, pattern):
+            return True
+        pass
+    pass
+    ignored = None
+    for gi in ignores:
+        v = gi(path, name, isdir)   # deeper .gitignore override shallower ones
+        if v is not None:
+            ignored = v
+        pass
+    pass
+    return ignored is True
+
+
+def is_script(path):
+    """
+    :param path: of a file without extension
+    :return: True for an executable with a "#!" line naming a known interpreter,
+             False for paths that cannot be stat-ed such as broken symlinks
+    """
+    try:
+        mode = os.stat(path).st_mode
+    except OSError:
+        return False
+    pass
+    return bool(mode & 0o111) and FT.sniff(path) is not None
+
+def get_paths(start_dir=".", excludes=[], gitignore=True, prune=PRUNE_DIRS, seen=None):
+    """
+    Retrieve files with names known to FileTypes from the start_dir and below, 
+    including executable scripts without extension identified by their "#!" line.
+
     :param start_dir: directory where to start searching
+    :param excludes: glob patterns for files and directories to skip 
+    :param gitignore: when True honour .gitignore files encountered in the walk
+    :param prune: names of directories that are never descended into
+    :param seen: optional set shared between calls to avoid repeating paths, 
+                 not needed for a single walk which cannot repeat a path 
     :return: generator that returns one path after the other
+
+    The walk is depth first in sorted name order, so the sequence of 
+    paths is reproducible. Paths are yielded as soon as found allowing 
+    processing to start before the walk completes. 
     """
-    paths = []
-    for root, dirs, files in os.walk(start_dir):
-        names = []
-        for pattern in fnpatterns:
-            names += fnmatch.filter(files, pattern)
-        pass 
-        for name in names:
+    ftype_of = FT.ftype_of
+    stack = [(start_dir, [])]
+    while stack:
+        root, ignores = stack.pop()
+        if gitignore:
+            gi = GitIgnore.load(root)
+            if gi is not None:
+                ignores = ignores + [gi]
+            pass
+        pass
+        try:
+            entries = sorted(scandir(root), key=lambda e:e.name)
+        except OSError as err:
+            log.warning("failed to list %s : %s " % (root, err))
+            continue
+        pass
+        subdirs = []
+        for e in entries:
+            name = e.name
             path = os.path.join(root, name)
-            if path in paths:
-                continue
-            paths.append(path)
-        pass 
-    pass 
-    return paths 
+            if e.is_dir(follow_symlinks=False):
+                if name in prune or is_excluded(path, name, True, excludes, ignores): continue
+                subdirs.append(path)
+            elif ftype_of(name) is not None or (not "." in name and is_script(path)):
+                if (excludes or ignores) and is_excluded(path, name, False, excludes, ignores): continue
+                if seen is not None:
+                    if path in seen: continue
+                    seen.add(path)
+                pass
+                yield path
+            pass
+        pass
+        stack.extend((subdir, ignores) for subdir in reversed(subdirs))
+    pass
+
+def iter_paths(args):
+    """
+    :return: generator of paths from the commandline, directories are walked with get_paths
+             or with args.git listed by git and filtered by file type, 
+             with args.shard only those of the shard are returned
+    """
+    seen = set()
+    roots = args.paths if len(args.paths) > 0 else [args.projdir]
+    for root in roots:
+        if os.path.isdir(root) and args.git is not None:
+            from gitpaths import git_paths
+            for path in git_paths(root, args.git, args.git_rev):
+                name = os.path.basename(path)
+                if path in seen: continue
+                if FT.ftype_of(name) is None and ("." in name or not is_script(path)): continue    # as get_paths
+                if args.exclude and is_excluded(path, name, False, args.exclude, []): continue
+                seen.add(path)
+                if in_shard(path, root, args.shard):
+                    yield path
+                pass
+            pass
+        elif os.path.isdir(root):
+            for path in get_paths(root, args.exclude, args.gitignore, seen=seen if len(roots) > 1 else None):
+                if in_shard(path, root, args.shard):
+                    yield path
+                pass
+            pass
+        elif not root in seen:
+            seen.add(root)
+            if in_shard(root, None, args.shard):
+                yield root
+            pass
+        pass
+    pass
+
+def in_shard(path, root, shard):
+    """
+    :param root: directory walked, or None for paths given directly 
+    :param shard: (k, n) of --shard K/N or None 
+    :return: True when the path belongs to the shard, see shards.py
+    """
+    if shard is None: return True
+    from shards import shard_key, shard_of
+    k, n = shard
+    return shard_of(shard_key(path, root), n) == k
 
-def parse_args():
+def parse_args(argv=None):
+    """
+    :param argv: list of arguments, default sys.argv[1:]
+    """
+    import argparse
     parser = argparse.ArgumentParser(description="License header updater")
     
     parser.add_argument("paths", nargs="*", default=[], help="File paths to process")
@@ -376,19 +896,129 @@ def parse_args():
     parser.add_argument("--owner", default="Opticks Team", help="Name of copyright owner")
     parser.add_argument("--projname", default="Opticks", help="Name of project")
     parser.add_argument("--projurl", default="https://bitbucket.org/simoncblyth/opticks", help="Url of project")
-    parser.add_argument("--enc", nargs=1, dest="encoding", default="utf-8",help="Encoding of program files")
+    parser.add_argument("--enc", dest="encoding", default="utf-8", help="Encoding of program files, only the header window is decoded")
     parser.add_argument("--level", default="info", help="logging level" )
     parser.add_argument("--update", action="store_true", default=False, help="Updating existing license, eg when changing to new year range" )
+    parser.add_argument("--git-staged", dest="git", action="store_const", const="staged", default=None, help="Process only files staged in the git index" )
+    parser.add_argument("--git-diff", dest="git_rev", default=None, help="Process only files changed relative to the git revision" )
+    parser.add_argument("--git-ls-files", dest="git", action="store_const", const="ls-files", help="Process the files tracked by git rather than walking the tree" )
+    parser.add_argument("--git-years", action="store_true", default=False, help="Use the first and last years of the git history of each file as its year range" )
+    parser.add_argument("--stdin", action="store_true", default=False, help="Filter stdin to stdout, requires --ftype" )
+    parser.add_argument("--ftype", default=None, choices=sorted(FT.types), help="File type of the --stdin content" )
+    parser.add_argument("--no-config", dest="config", action="store_false", default=True, help="Ignore per-directory .licensehd files overriding --tmpl --years --owner --projname --projurl, see dirconfig.py" )
+    parser.add_argument("--exclude", action="append", default=[], help="Glob of files or directories to skip, can be repeated, eg --exclude build --exclude vendor" )
+    parser.add_argument("--no-gitignore", dest="gitignore", action="store_false", default=True, help="Do not honour .gitignore files" )
+    parser.add_argument("--fsync", choices=["none","batch","file"], default="none", help="Durability of rewrites: none, batch for one sync per group of files or file for per-file fsync" )
+    parser.add_argument("--fsync-batch", type=int, default=1000, help="Number of rewritten files per group sync with --fsync batch or per --transaction batch" )
+    parser.add_argument("--transaction", action="store_true", default=False, help="Stage rewrites and apply them in journaled batches that can be recovered and rolled back, see journal.py" )
+    parser.add_argument("--journal", default=None, help="Path of the --transaction journal, default %s in the directory processed" % ".licensehd.journal" )
+    parser.add_argument("--rollback", action="store_true", default=False, help="Undo the last committed batch of the journal and exit" )
+    parser.add_argument("--cache", default="", help="Path of the incremental cache, default %s within the .git directory of the checkout processed, otherwise in ~/.cache/licensehd" % ".licensehd.cache" )
+    parser.add_argument("--no-cache", dest="cache", action="store_const", const=None, help="Do not use or update the incremental cache" )
+    parser.add_argument("--check", action="store_true", default=False, help="Read only check, exits non-zero when any file has a missing or stale header" )
+    parser.add_argument("--fail-fast", action="store_true", default=False, help="With --check stop at the first failure" )
+    parser.add_argument("--report", choices=["table","jsonl","none"], default="table", help="Per file output: table of --check failures or JSON Lines of every result" )
+    parser.add_argument("--shard", default=None, help="Process only shard K of N, eg 2/8, of the paths partitioned by a stable hash, see shards.py" )
+    parser.add_argument("--report-json", default=None, help="Path to write a JSON summary of action and msg counts and failures, for merging shards with shards.py" )
+    parser.add_argument("--inventory", nargs="?", const="", default=None, help="Read only run recording the header of every file in an index for querying with inventory.py, default %s in the directory processed" % ".licensehd.inventory" )
+    parser.add_argument("--watch", action="store_true", default=False, help="Following the initial sweep keep running, processing files as they appear or change, see watch.py" )
+    parser.add_argument("--watch-mode", choices=["auto","inotify","poll"], default="auto", help="How --watch notices changes, auto uses inotify where available" )
+    parser.add_argument("--watch-interval", type=float, default=1.0, help="Seconds between polls of directory mtimes with --watch" )
+    parser.add_argument("--debounce", type=float, default=0.5, help="Seconds without further changes before a --watch file is processed" )
+    parser.add_argument("--archive", default=None, help="Process the members of a tar or zip without extracting it, \"-\" for a tar on stdin, see archive.py" )
+    parser.add_argument("--archive-out", default=None, help="Path to write the --archive with the headers applied, \"-\" for a tar on stdout" )
+    parser.add_argument("--stats", action="store_true", default=False, help="Report per phase timings, byte and file counts and the slowest files" )
+    parser.add_argument("--slowest", type=int, default=10, help="Number of slowest files listed by --stats" )
+    parser.add_argument("--profile", default=None, help="Path to write cProfile pstats of the run" )
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of parallel workers, 0 for one per core" )
+    parser.add_argument("--threads", action="store_true", default=False, help="Use a thread pool rather than processes, eg for network filesystems" )
+    parser.add_argument("--chunksize", type=int, default=64, help="Number of paths handed to a worker at a time" )
     
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     fmt = '[%(asctime)s] p%(process)s {%(pathname)s:%(lineno)d} %(levelname)s - %(message)s'
     #fmt = '[%(asctime)s] p%(process)s {%(lineno)d} %(levelname)s - %(message)s'
     level=getattr(logging,args.level.upper())
     logging.basicConfig(level=level, format=fmt)
 
+    if args.stdin and args.ftype is None:
+        parser.error("--stdin requires --ftype")
+    pass
+    if args.git_rev is not None:
+        args.git = "diff"
+    pass
+    if args.watch and (args.stdin or args.git is not None or args.inventory is not None or args.transaction):
+        parser.error("--watch cannot be combined with --stdin, --git-*, --inventory or --transaction")
+    pass
+    if args.watch and not all(path is not None and os.path.isdir(path) for path in args.paths or [args.projdir]):
+        parser.error("--watch requires directories")
+    pass
+    if args.watch and len(args.paths) == 0:
+        args.paths = [args.projdir]
+    pass
+    if args.archive is not None and (args.stdin or args.watch or args.transaction or args.inventory is not None or args.git is not None or args.git_years or len(args.paths) > 0):
+        parser.error("--archive cannot be combined with paths, --stdin, --watch, --transaction, --inventory or --git-*")
+    pass
+    if args.archive is not None and args.archive_out is None and not args.check:
+        parser.error("--archive requires --archive-out or --check")
+    pass
+    if args.archive is not None and args.archive_out is not None and args.archive != "-" and os.path.abspath(args.archive) == os.path.abspath(args.archive_out):
+        parser.error("--archive-out must differ from --archive")
+    pass
+    if args.archive is not None and args.archive_out == "-" and not args.check and args.report == "jsonl":
+        parser.error("--report jsonl cannot be combined with --archive-out -, as both write to stdout")
+    pass
+    if args.inventory is not None:
+        from inventory import Inventory
+        if args.inventory == "":
+            args.inventory = Inventory.default_path(args)
+        pass
+        args.check = True     # read only, the Inventory takes the place of the cache
+        args.cache = None
+    pass
+    if args.cache == "":
+        from statcache import StatCache
+        args.cache = StatCache.default_path(args)   # out of the worktree
+    pass
+    if args.journal is None and (args.transaction or args.rollback):
+        from journal import Journal
+        args.journal = Journal.default_path(args)
+    pass
+    if args.shard is not None:
+        from shards import parse_shard
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as err:
+            parser.error(str(err))
+        pass
+    pass
+    try:
+        codecs.lookup(args.encoding)
+    except LookupError:
+        parser.error("unknown encoding %s " % args.encoding)
+    pass
+    if args.jobs == 0:
+        import multiprocessing
+        args.jobs = multiprocessing.cpu_count()
+    pass
+
     args.d = dict(years=args.years, owner=args.owner, projectname=args.projname, projecturl=args.projurl )  
-    template_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "%s.tmpl" % args.tmpl )
-    args.template = LicenseTmpl( template_path, args )
+    args.template = LicenseTmpl( template_path(args.tmpl), args )
+
+    args.configs = None
+    if args.config and not args.stdin and args.archive is None:
+        from dirconfig import DirConfigs
+        args.configs = DirConfigs(args)
+    pass
+
+    args.years_index = None
+    if args.git_years:
+        from gitpaths import git_years
+        roots = args.paths if len(args.paths) > 0 else [args.projdir]
+        args.years_index = {}
+        for root in roots:
+            args.years_index.update(git_years(root if os.path.isdir(root) else os.path.dirname(root) or "."))
+        pass
+    pass
 
     return args
 
@@ -398,29 +1028,468 @@ def test_template(args):
     for a in "a.py a.c a.bash".split():
         print("".join([a+"\n"]+tmpl(a))) 
 
-if __name__ == '__main__':
+def process_path(path, args):
+    """
+    Parse the head of a single path and rewrite it when needed. 
+    This is the unit of work handed to the pool workers.
+    With args.check the file is only classified, never opened for writing. 
 
-    args = parse_args()
-    log.debug(" paths %d " % len(args.paths))
+    Errors with a single file, such as content that does not decode with 
+    args.encoding, are returned as a "failed" result with msg "error" 
+    rather than raised, so one bad file does not stop the run. 
+
+    :param path: 
+    :param args: parsed arguments with args.template 
+    :return odict: LicenseHD.result  
+    """
+    try:
+        lh = LicenseHD(path, args)
+        r = lh.result()
+        if lh.binary is not None:
+            r["action"] = "skipped"    # binary or wide encoding, not decoded 
+        elif lh.has_other_license:
+            r["action"] = "skipped"
+        elif lh.uptodate:
+            r["action"] = "unchanged"    # no writes, so mtime is not bumped 
+        elif args.check:
+            r["action"] = "stale" if lh.has_license else "missing"
+        elif args.transaction:
+            staged = lh.stage()     # renamed into place by the Journal in the parent 
+            stamp = None if staged is None else staged[1]
+            if staged is not None:
+                r["staged"], r["undo"] = staged[0], staged[2]
+            pass
+            r["action"] = "rewritten" if staged is not None else "failed"
+        else:
+            stamp = lh.write()
+            r["written"] = stamp is not None
+            r["action"] = "rewritten" if r["written"] else "failed"
+        pass 
+    except (UnicodeError, AssertionError, IOError, OSError) as err:
+        return error_result(path, err)
+    pass
+    if args.cache is not None:
+        from statcache import StatCache, stat_stamp
+        if r["action"] == "rewritten":
+            r.update(stamp)    # from the staging, avoiding a re-read 
+        elif r["action"] in StatCache.actions:
+            r["mtime"], r["size"] = stat_stamp(os.stat(path))
+            r["hash"] = None    # not hashed, as that would read the whole file where the header window sufficed 
+        pass
+    pass
+    if args.inventory is not None:
+        from inventory import header_fingerprint
+        from statcache import stat_stamp
+        r["fingerprint"], r["header"] = header_fingerprint(lh._header)
+        r["mtime"], r["size"] = stat_stamp(os.stat(path))
+    pass
+    if lh.stats is not None:
+        r["stats"] = lh.stats 
+    pass
+    return r
+
+def error_result(path, err):
+    """
+    :return odict: with the keys of LicenseHD.result, action "failed", msg "error" and the error 
+    """
+    log.warning("failed %s : %s: %s " % (path, type(err).__name__, err))
+    r = odict()
+    r["path"] = path
+    r["ftype"] = FT.ftype_of(os.path.basename(path))
+    for k in ["skip", "headStart", "headEnd", "copyrightLine", "otherCopyrightLine"]:
+        r[k] = -1 
     pass
-    if len(args.paths) == 1 and os.path.isdir(args.paths[0]):
-        paths = get_paths(FT.patterns, args.paths[0])
-    elif len(args.paths) > 0:
-        paths = args.paths
-    elif not args.projdir is None:  
-        paths = get_paths(FT.patterns, args.projdir)  
+    r["comment"] = ""
+    r["msg"] = "error"
+    r["uptodate"] = False
+    r["written"] = False
+    r["action"] = "failed"
+    r["error"] = "%s: %s" % (type(err).__name__, err)
+    return r
+
+
+def load_template(name="under-apache-2", years="2019-2019", owner="Opticks Team", projname="Opticks", projurl="https://bitbucket.org/simoncblyth/opticks"):
+    """
+    :param name: of template in the templates directory
+    :return LicenseTmpl: with the substitutions applied, for use with apply_header
+    """
+    import argparse
+    args = argparse.Namespace()
+    args.d = dict(years=years, owner=owner, projectname=projname, projecturl=projurl)
+    return LicenseTmpl(template_path(name), args)
+
+def template_path(name):
+    return os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "%s.tmpl" % name )
+
+def apply_header(text, ftype, template, encoding="utf-8", check=False):
+    """
+    In memory counterpart of process_path for editor and build integration, 
+    no files are read or written::
+
+        from licensehd import apply_header, load_template
+        tmpl = load_template("bsd-3", years="2020", owner="Someone")
+        r = apply_header(open("a.c").read(), "c", tmpl)
+        r["action"], r["text"]
+
+    :param text: content as str or bytes, bytes are only decoded within the header window 
+    :param ftype: file type key of FileTypes.typeSettings, eg "c" or "python"
+    :param template: LicenseTmpl 
+    :param encoding: of the bytes, or used to encode str
+    :param check: when True only classify, as with --check
+    :return odict: LicenseHD.result with action and text, text being of the same type as the input 
+    """
+    import argparse
+    args = argparse.Namespace(template=template, encoding=encoding, stats=False, years_index=None)
+    lh = LicenseHD("<%s>" % ftype, args, text=text, ftype=ftype)
+    r = lh.result()
+    out = text 
+    if lh.binary is not None or lh.has_other_license:
+        r["action"] = "skipped"
+    elif lh.uptodate:
+        r["action"] = "unchanged"
+    elif check:
+        r["action"] = "stale" if lh.has_license else "missing"
     else:
-        assert 0
+        rewritten = lh.rewrite_bytes()
+        r["action"] = "failed" if rewritten is None else "rewritten"
+        if rewritten is not None:
+            out = rewritten if isinstance(text, bytes) else rewritten.decode(lh.encoding, ESCAPE)
+        pass
     pass
-    for path in paths:
-        lh = LicenseHD(path, args)
-        #print("%r" % lh )
-        if lh.has_other_license:
+    r["text"] = out
+    return r
+
+def stdin_filter(args):
+    """
+    Filter stdin to stdout applying the header for args.ftype, with --check 
+    nothing is written and only the return code reports the state.
+
+    :return rc: non-zero for check failures or a vetoed update
+    """
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    data = stdin.read()
+    try:
+        r = apply_header(data, args.ftype, args.template, encoding=args.encoding, check=args.check)
+    except (UnicodeError, AssertionError, IOError, OSError) as err:    # as process_path
+        r = error_result("<stdin>", err)
+        r["text"] = data     # passed through unchanged 
+    pass
+    log.debug(REPR_FMT % r)
+    if not args.check:
+        stdout.write(r["text"])
+        stdout.flush()
+    pass
+    return 1 if r["action"] in CHECK_FAILS + ["failed"] else 0
+
+
+ACTIONS = ["unchanged", "rewritten", "skipped", "failed", "stale", "missing"]
+CHECK_FAILS = ["stale", "missing"]
+CHECK_FMT = " %(action)-10s" + REPR_FMT
+
+def summary(counts):
+    return " ".join(["total %d" % sum(counts.values())] + ["%s %d" % (k, counts.get(k,0)) for k in ACTIONS if counts.get(k,0) > 0])
+
+
+_worker_args = None
+
+def _init_worker(args):
+    global _worker_args
+    _worker_args = args 
+    if not args.threads:
+        import signal
+        signal.signal(signal.SIGTERM, _terminate_worker)   # pool.terminate, let LicenseHD.stage remove its temporary file 
+        signal.signal(signal.SIGINT, signal.SIG_IGN)       # Ctrl-C is handled by the parent, which decides between terminate and drain
+
+def _terminate_worker(signum, frame):
+    sys.exit(1)
+
+def _process_chunk_worker(paths):
+    return [process_path(path, _worker_args) for path in paths]
+
+def chunked(it, n):
+    """
+    :return: generator of lists of up to n items of the iterable
+    """
+    chunk = []
+    for item in it:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+        pass
+    pass
+    if len(chunk) > 0:
+        yield chunk
+    pass
+
+
+class Backpressure(object):
+    """
+    Bounds the number of paths taken from the discovery generator ahead 
+    of the results consumed. Without this the task feeder thread of Pool.imap 
+    drains the input as fast as the walk allows, so on a tree of millions 
+    of files the paths and pending tasks would pile up in memory. 
+    The limit must be at least the chunksize, as only complete chunks are dispatched.
+    """
+    def __init__(self, paths, limit):
+        import threading
+        self.paths = iter(paths)
+        self.sem = threading.Semaphore(limit)
+        self.closed = False
+
+    def __iter__(self):
+        while True:
+            self.sem.acquire()
+            if self.closed: return
+            try:
+                path = next(self.paths)
+            except StopIteration:
+                return
+            pass
+            yield path
+        pass
+
+    def release(self):
+        """called as each result is consumed"""
+        self.sem.release()
+
+    def close(self):
+        """unblock the feeder when abandoning the run"""
+        self.closed = True
+        self.sem.release()
+
+
+def run(paths, args, discard=None):
+    """
+    :param paths: iterable of paths, consumed lazily
+    :param args: 
+    :param discard: when given, a run abandoned by the consumer stops taking paths but lets the 
+                    workers complete the paths already handed out, passing each unconsumed result 
+                    to discard, eg to remove the files staged by --transaction, rather than terminating the pool 
+    :return: generator of process_path results in the same order as the paths 
+
+    Processing is a pipeline of generators: discover (iter_paths, the cache filter), 
+    classify and rewrite (process_path), and the consumer of the results. 
+    Each stage pulls from the previous, so only a bounded number of paths 
+    are ever in flight and memory use does not grow with the size of the tree.  
+
+    With args.jobs > 1 the paths are handed out to a pool of workers in 
+    chunks of args.chunksize, with at most args.jobs*args.chunksize*4 paths 
+    taken ahead of the results consumed. Processes are used by default, threads with 
+    args.threads which suits network filesystems where the time goes 
+    waiting on I/O rather than in the parsing.  
+    """
+    if args.jobs < 2:
+        for path in paths:
+            yield process_path(path, args)
+        pass
+        return 
+    pass
+    import multiprocessing
+    from multiprocessing.pool import ThreadPool
+    Pool = ThreadPool if args.threads else multiprocessing.Pool 
+    pool = Pool(args.jobs, _init_worker, (args,))
+    bp = Backpressure(paths, args.jobs*args.chunksize*4)
+    from collections import deque
+    completed = False
+    pending = deque()     # results of the current chunk not yet consumed 
+    it = pool.imap(_process_chunk_worker, chunked(bp, args.chunksize))   # chunked here, as an exception within the generator that imap uses to flatten chunks would end it
+    try:
+        for rs in it:
+            pending.extend(rs)
+            while pending:
+                r = pending.popleft()
+                bp.release()
+                yield r
+            pass
+        pass
+        completed = True
+    finally:
+        if completed:
+            pool.close()
+        elif discard is not None:
+            bp.close()
+            pool.close()
+            for r in pending:
+                discard(r)
+            pass
+            for rs in it:     # drain, so no worker output is left behind 
+                for r in rs:
+                    discard(r)
+                pass
             pass
-        elif lh.has_license and args.update:  
-            lh.write()
         else:
-            lh.write()
+            bp.close()
+            pool.terminate()   # abandoned, eg by --fail-fast, or an exception 
+        pass
+        pool.join()
+    pass
+
+
+def main(argv=None):
+    """
+    :param argv: list of arguments, default sys.argv[1:]
+    :return rc: non-zero when --check finds files with missing or stale headers, or any file failed with an error
+    """
+    args = parse_args(argv)
+    log.debug(" paths %d " % len(args.paths))
+    pass
+    if args.stdin:
+        return stdin_filter(args)
+    pass
+    if args.archive is not None:
+        from archive import archive_filter
+        return archive_filter(args)
+    pass
+    if args.rollback:
+        from journal import Journal
+        try:
+            restored, nskip = Journal(args.journal).rollback()
+        except LookupError as err:
+            log.fatal(str(err))
+            return 2
+        pass
+        if args.cache is not None and os.path.exists(args.cache):
+            from statcache import StatCache
+            cache = StatCache(args.cache, StatCache.fingerprint(args, LicenseHD.headlines))
+            cache.forget(restored)    # their rows describe the rewritten content 
+            cache.close()
+        pass
+        return 1 if nskip > 0 else 0
+    pass
+    assert len(args.paths) > 0 or not args.projdir is None
+    if args.profile is not None:
+        import cProfile
+        prof = cProfile.Profile()
+        rc = prof.runcall(_main, args)
+        prof.dump_stats(args.profile)
+        log.info("wrote profile to %s " % args.profile)    # of the initial sweep with --watch
+    else:
+        rc = _main(args)
+    pass
+    if args.watch:
+        from watch import Watcher
+        rc = max(rc, Watcher(args).loop())
+    pass
+    return rc
+
+def _main(args):
+    import json
+    from statcache import StatCache
+    from runstats import RunStats
+    stats = RunStats(args.slowest) if args.stats else None
+    paths = iter_paths(args)
+    if stats is not None:
+        paths = stats.timed_iter(paths, "walk")
+    pass
+    counts = {}
+    msgs = {}
+    failed = []
+    bsync = BatchSync(args.fsync_batch) if args.fsync == "batch" else None
+    cache = StatCache(args.cache, StatCache.fingerprint(args, LicenseHD.headlines), args.configs) if args.cache is not None else None
+    if cache is not None:
+        paths = cache.filter(paths, counts, msgs, stats)
+    pass
+    inv = None
+    if args.inventory is not None:
+        from inventory import Inventory
+        roots = args.paths if len(args.paths) > 0 else [args.projdir]
+        inv = Inventory(args.inventory, StatCache.fingerprint(args, LicenseHD.headlines), " ".join(os.path.abspath(root) for root in roots), args.configs)
+        paths = inv.filter(paths, counts, msgs)
+    pass
+    journal = None
+    if args.transaction:
+        from journal import Journal
+        journal = Journal(args.journal, args.fsync_batch, None if cache is None else cache.record)    # rewrites are cached once committed 
+        journal.begin()
+    pass
+    failures = 0 
+    errors = 0 
+    results = run(paths, args, None if journal is None else journal.discard)
+    r = None
+    try:
+        for r in results:
+            log.debug(REPR_FMT % r)
+            counts[r["action"]] = counts.get(r["action"], 0) + 1 
+            msgs[r["msg"]] = msgs.get(r["msg"], 0) + 1 
+            if r["action"] == "failed" or (inv is None and r["action"] in CHECK_FAILS):
+                failed.append(dict(path=r["path"], action=r["action"], msg=r["msg"], error=r.get("error")))
+            pass
+            if "error" in r:
+                errors += 1 
+            pass
+            if stats is not None:
+                stats.add(r)
+            pass
+            staged = journal is not None and "staged" in r
+            if staged:
+                journal.stage(r)
+            pass
+            if args.report == "jsonl":
+                print(json.dumps(r))
+            pass
+            if inv is not None:
+                inv.record(r)
+            elif args.check and r["action"] in CHECK_FAILS:
+                failures += 1 
+                if args.report == "table":
+                    print(CHECK_FMT % r)
+                pass
+            pass
+            if bsync is not None and r["written"]:
+                bsync.add(r["path"])
+            pass
+            if cache is not None and not staged:
+                cache.record(r)
+            pass
+            if failures > 0 and args.fail_fast:
+                break
+            pass
         pass 
-    pass 
+    except BaseException:
+        if journal is not None:
+            if r is not None:
+                journal.discard(r)    # when interrupted before it was journaled
+            pass
+            results.close()    # drains the pool, discarding the rewrites staged for results not consumed
+            journal.abort()
+        pass
+        if cache is not None:
+            cache.close()    # keeping the rows recorded, for files as they are on disk 
+        pass
+        raise
+    pass
+    results.close()
+    if journal is not None:
+        journal.end()
+    pass
+    if bsync is not None:
+        bsync.flush()
+    pass
+    if cache is not None:
+        log.info("%r hits %d " % (cache, cache.hits))
+        walked = [] if args.git is not None or args.shard is not None else [root for root in (args.paths or [args.projdir]) if os.path.isdir(root)]
+        cache.close(walked)
+    pass
+    if inv is not None:
+        inv.close()
+    pass
+    if stats is not None:
+        stats.log()
+    pass
+    log.info(summary(counts))
+    if errors > 0:
+        log.warning("%d files failed with errors, see the warnings above or the error of the --report jsonl results " % errors)
+    pass
+    if args.report_json is not None:
+        from shards import make_report, write_report
+        shard = None if args.shard is None else "%d/%d" % args.shard
+        write_report(args.report_json, make_report(shard, counts, msgs, failed))
+    pass
+    return 1 if failures > 0 or errors > 0 else 0 
+
+
+if __name__ == '__main__':
+    sys.exit(main())
 
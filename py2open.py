@@ -6,7 +6,7 @@ Workaround lack of encoding in py2:open
 import sys
 
 if sys.version_info[0] > 2:   # py3
-    pass
+    from io import open
 else:  # py2
     import codecs
     import warnings
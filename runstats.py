@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+"""
+runstats.py
+=============
+
+Collection of the --stats report for a licensehd.py run.
+
+Per file timings are taken by the workers only when args.stats is set,
+and passed back within the result dicts as r["stats"], so without --stats
+the cost is a few untaken branches. The parent accumulates:
+
+* wall and CPU time per phase : walk, cache, read, parse, write
+* bytes read and written
+* file counts per msg, per ftype and per action
+* the slowest N files
+
+::
+
+    licensehd.py ~/opticks --stats --slowest 20
+    licensehd.py ~/opticks --profile /tmp/licensehd.pstats
+    python -c "import pstats; pstats.Stats('/tmp/licensehd.pstats').sort_stats('cumulative').print_stats(30)"
+
+"""
+import time, heapq, logging
+from collections import OrderedDict as odict
+log = logging.getLogger(__name__)
+
+timer = getattr(time, "perf_counter", time.time)
+cpu = getattr(time, "process_time", None) or time.clock   # py2 lacks process_time
+
+PHASES = ["walk", "cache", "read", "parse", "write"]
+
+
+class RunStats(object):
+    def __init__(self, slowest=10):
+        self.slowest = slowest
+        self.wall = odict((k, 0.) for k in PHASES)
+        self.cpu = odict((k, 0.) for k in PHASES)
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.msg = {}
+        self.ftype = {}
+        self.action = {}
+        self.heap = []
+        self.t0 = timer()
+        self.c0 = cpu()
+
+    def timed_iter(self, it, phase):
+        """
+        :param it: iterable, eg of paths
+        :param phase: name under which the time spent producing the items is accumulated
+        :return: generator of the items
+        """
+        it = iter(it)
+        while True:
+            t0, c0 = timer(), cpu()
+            try:
+                item = next(it)
+            except StopIteration:
+                return
+            finally:
+                self.wall[phase] += timer() - t0
+                self.cpu[phase] += cpu() - c0
+            pass
+            yield item
+        pass
+
+    def charge(self, phase, t0, c0):
+        """
+        accumulate the time since t0, c0 under phase, for work interleaved with other phases
+        """
+        self.wall[phase] += timer() - t0
+        self.cpu[phase] += cpu() - c0
+
+    def add(self, r):
+        """
+        :param r: process_path result with r["stats"]
+        """
+        for d, k in [(self.msg, r["msg"]), (self.ftype, r["ftype"]), (self.action, r["action"])]:
+            d[k] = d.get(k, 0) + 1
+        pass
+        s = r.get("stats")
+        if s is None: return
+        for phase in ["read", "parse", "write"]:
+            self.wall[phase] += s.get(phase, 0.)
+            self.cpu[phase] += s.get(phase+"_cpu", 0.)
+        pass
+        self.bytes_read += s.get("bytes_read", 0)
+        self.bytes_written += s.get("bytes_written", 0)
+
+        t = s.get("read", 0.) + s.get("parse", 0.) + s.get("write", 0.)
+        item = (t, r["path"])
+        if len(self.heap) < self.slowest:
+            heapq.heappush(self.heap, item)
+        elif item > self.heap[0]:
+            heapq.heapreplace(self.heap, item)
+        pass
+
+    def report(self):
+        """
+        :return lines: of the report
+        """
+        wall = timer() - self.t0
+        lines = ["run wall %10.3f s cpu %10.3f s (parent) " % (wall, cpu() - self.c0)]
+        lines.append("%-10s %12s %12s   (read, parse and write summed over workers)" % ("phase", "wall/s", "cpu/s"))
+        for phase in PHASES:
+            lines.append("%-10s %12.3f %12.3f" % (phase, self.wall[phase], self.cpu[phase]))
+        pass
+        lines.append("bytes read %d written %d " % (self.bytes_read, self.bytes_written))
+        for label, d in [("msg", self.msg), ("ftype", self.ftype), ("action", self.action)]:
+            lines.append("%-6s : %s " % (label, " ".join(["%s %d" % (k, d[k]) for k in sorted(d, key=str)])))
+        pass
+        lines.append("slowest %d files (read+parse+write)" % len(self.heap))
+        for t, path in sorted(self.heap, reverse=True):
+            lines.append("%10.6f %s " % (t, path))
+        pass
+        return lines
+
+    def log(self):
+        for line in self.report():
+            log.info(line)
+        pass
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+"""
+shards.py
+===========
+
+Deterministic partitioning of the candidate paths of a licensehd.py run
+across N machines, without any coordination between them::
+
+    licensehd.py ~/opticks --update --shard 1/4 --report-json shard-1.json   # on node 1
+    licensehd.py ~/opticks --update --shard 2/4 --report-json shard-2.json   # on node 2
+    ...
+    python shards.py shard-*.json > summary.json
+
+K is 1-based. Each path goes to the shard given by a stable hash of its
+path relative to the walked root, with "/" separators, so all nodes
+agree regardless of where the tree is checked out and the assignment
+does not change with the addition or removal of other files.
+
+Merging the per-shard reports sums the action and msg counts, concatenates
+the failures and notes any of the N shards without a report. The merge exits
+non-zero when there are failures or missing shards.
+
+"""
+import os, sys, json, hashlib, logging
+log = logging.getLogger(__name__)
+
+
+def parse_shard(s):
+    """
+    :param s: "K/N" string with 1 <= K <= N
+    :return (k, n): ints
+    """
+    try:
+        k, n = [int(v) for v in s.split("/")]
+    except ValueError:
+        raise ValueError("shard must be K/N, eg 1/4 : %r " % s)
+    pass
+    if not (n > 0 and 1 <= k <= n):
+        raise ValueError("shard K/N requires 1 <= K <= N : %r " % s)
+    pass
+    return k, n
+
+def shard_key(path, root=None):
+    """
+    :param path:
+    :param root: directory walked, the key is the path relative to it
+    :return key: "/" separated
+    """
+    key = path if root is None else os.path.relpath(path, root)
+    return key.replace(os.sep, "/")
+
+def shard_of(key, n):
+    """
+    :return k: 1-based shard of the key, the same on every platform and python version unlike hash
+    """
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8", "surrogateescape") if sys.version_info[0] > 2 else key.encode("utf-8")
+    pass
+    return int(hashlib.md5(key).hexdigest()[:8], 16) % n + 1
+
+
+def make_report(shard, counts, msgs, failures):
+    """
+    :param shard: "K/N" or None when the run was not sharded
+    :param counts: dict of action counts
+    :param msgs: dict of msg counts
+    :param failures: list of dict with path, action and msg
+    :return d: JSON serializable report
+    """
+    return dict(shard=shard, total=sum(counts.values()), counts=counts, msg=msgs, failures=failures)
+
+def write_report(path, d):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(d, f, indent=1, sort_keys=True)
+    pass
+    getattr(os, "replace", os.rename)(tmp, path)
+
+def merge(reports):
+    """
+    :param reports: list of report dicts from make_report
+    :return d: merged report with "shards" of the reports and "missing" shards
+    """
+    counts, msgs, failures, shards = {}, {}, [], []
+    n = None
+    for d in reports:
+        for k, v in d["counts"].items():
+            counts[k] = counts.get(k, 0) + v
+        pass
+        for k, v in d["msg"].items():
+            msgs[k] = msgs.get(k, 0) + v
+        pass
+        failures.extend(d["failures"])
+        if d.get("shard") is not None:
+            k, n1 = parse_shard(d["shard"])
+            if n is not None and n1 != n:
+                raise ValueError("cannot merge reports from different shard counts %d %d " % (n, n1))
+            pass
+            n = n1
+            if k in shards:
+                log.warning("duplicate report for shard %s " % d["shard"])
+            pass
+            shards.append(k)
+        pass
+    pass
+    missing = [] if n is None else [k for k in range(1, n+1) if not k in shards]
+    failures = sorted(failures, key=lambda f:f["path"])
+    out = make_report(None, counts, msgs, failures)
+    out["shards"] = ["%d/%d" % (k, n) for k in sorted(shards)]
+    out["missing"] = ["%d/%d" % (k, n) for k in missing]
+    return out
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Merge per-shard licensehd.py --report-json reports")
+    parser.add_argument("reports", nargs="+", help="Paths of the JSON reports")
+    parser.add_argument("-o", "--output", default=None, help="Path to write the merged report, default stdout")
+    parser.add_argument("--level", default="info", help="logging level")
+    opt = parser.parse_args()
+    logging.basicConfig(level=getattr(logging, opt.level.upper()), format="%(message)s")
+
+    reports = []
+    for path in opt.reports:
+        with open(path, "r") as f:
+            reports.append(json.load(f))
+        pass
+    pass
+    out = merge(reports)
+    if opt.output is None:
+        json.dump(out, sys.stdout, indent=1, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        write_report(opt.output, out)
+    pass
+    if len(out["missing"]) > 0:
+        log.fatal("missing reports for shards %s " % " ".join(out["missing"]))
+    pass
+    return 1 if len(out["failures"]) > 0 or len(out["missing"]) > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+"""
+statcache.py
+==============
+
+Persistent record of the outcome for each path processed by licensehd.py,
+allowing re-runs to skip files that have not changed since the last run
+without opening them.
+
+Each row holds the path, its mtime, size and content hash together with the
+fingerprint of the template rendering and the resulting LicenseHD msg.
+A path is skipped when:
+
+* mtime and size match and the fingerprint is unchanged : no file access beyond the stat
+* size matches but the mtime differs (eg after a git checkout) and the content hash matches
+
+Only files rewritten by a run have their content hash recorded, from the bytes
+as they are written. Other files are classified from their header window alone,
+so hashing them in full would cost more than re-reading them when the mtime changes.
+
+Rows for paths beneath the walked directories that are not encountered by a run
+and no longer exist are evicted on close. Runs that see only part of a tree, 
+with --git-*, --shard or file paths, evict nothing so their cost scales with 
+the paths processed.
+
+::
+
+    licensehd.py ~/opticks              # uses ~/opticks/.git/.licensehd.cache
+    licensehd.py ~/opticks --check      # the same cache
+    licensehd.py ~/tarball              # outside a git checkout: ~/.cache/licensehd/<digest of the directory>.cache
+    licensehd.py ~/opticks --no-cache
+
+The cache is kept out of the worktree, so runs such as pre-commit hooks
+leave no untracked files behind. It goes in the .git directory of the
+enclosing checkout, otherwise in $XDG_CACHE_HOME/licensehd, by default
+~/.cache/licensehd.
+
+"""
+import os, logging, hashlib, threading
+log = logging.getLogger(__name__)
+
+
+def file_digest(path, bufsize=1<<20):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            buf = f.read(bufsize)
+            if not buf: break
+            h.update(buf)
+        pass
+    pass
+    return h.hexdigest()
+
+def stat_stamp(st):
+    """
+    :return (mtime, size): mtime in integer nanoseconds
+    """
+    mtime = getattr(st, "st_mtime_ns", None)
+    if mtime is None:
+        mtime = int(st.st_mtime*1e9)   # py2
+    pass
+    return mtime, st.st_size
+
+
+class StatCache(object):
+    """
+    SQLite backed cache, only ever accessed from the parent process. 
+    The lock is needed as a pool task feeder thread drives filter while 
+    the main thread does the record.
+    """
+    name = ".licensehd.cache"
+    version = "1"
+    commit_every = 1000
+    actions = ("unchanged", "rewritten", "skipped")   # outcomes that are recorded, others are reprocessed
+
+    @classmethod
+    def default_root(cls, args):
+        """
+        :return root: directory being processed, or the invoking directory
+        """
+        if args.projdir is not None:
+            root = args.projdir
+        elif len(args.paths) == 1 and os.path.isdir(args.paths[0]):
+            root = args.paths[0]
+        else:
+            root = "."
+        pass
+        return root
+
+    @classmethod
+    def default_path(cls, args):
+        """
+        :return path: default cache, kept out of the worktree: within the .git directory of the
+                      checkout enclosing the directory being processed, otherwise in the user 
+                      cache directory named by a digest of the directory
+        """
+        root = os.path.abspath(cls.default_root(args))
+        fold = root
+        while True:
+            gitdir = os.path.join(fold, ".git")
+            if os.path.isdir(gitdir):
+                return os.path.join(gitdir, cls.name)
+            pass
+            parent = os.path.dirname(fold)
+            if parent == fold: break
+            fold = parent
+        pass
+        base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        return os.path.join(base, "licensehd", hashlib.sha1(root.encode("utf-8")).hexdigest()[:16] + ".cache")
+
+    @classmethod
+    def fingerprint(cls, args, headlines):
+        """
+        :return hexdigest: of everything other than file content that influences the outcome
+        """
+        h = hashlib.sha1()
+        for item in [cls.version, str(headlines), str(args.encoding), str(args.git_years)] + list(args.template.lines):
+            h.update(item.encode("utf-8"))
+            h.update(b"\0")
+        pass
+        return h.hexdigest()
+
+    def __init__(self, path, fingerprint, configs=None):
+        """
+        :param path: of the cache
+        :param fingerprint: of the run, see StatCache.fingerprint
+        :param configs: DirConfigs, whose digest is folded into the fingerprint of paths under a .licensehd
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.configs = configs
+        self.fingerprints = {}   # DirConfigs digest -> combined fingerprint 
+        fold = os.path.dirname(path)
+        if fold and not os.path.isdir(fold):
+            try:
+                os.makedirs(fold)
+            except OSError:
+                pass    # created by a concurrent run, otherwise sqlite3 fails below 
+            pass
+        pass
+        import sqlite3
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER, hash TEXT, fingerprint TEXT, msg TEXT, action TEXT)")
+        self.seen = set()
+        self.pending = 0
+        self.hits = 0
+
+    def execute(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def fingerprint_of(self, path):
+        """
+        :return fingerprint: of the run, combined with that of the template of the path when overridden by a .licensehd
+        """
+        digest = None if self.configs is None else self.configs.digest(path)
+        if digest is None: return self.fingerprint
+        fp = self.fingerprints.get(digest)
+        if fp is None:
+            fp = hashlib.sha1((self.fingerprint + digest).encode("utf-8")).hexdigest()
+            self.fingerprints[digest] = fp
+        pass
+        return fp
+
+    def lookup(self, key):
+        rows = self.execute("SELECT mtime, size, hash, fingerprint, action, msg FROM files WHERE path = ?", (key,))
+        return rows[0] if len(rows) > 0 else None
+
+    def hit(self, path):
+        """
+        :return (action, msg): recorded when the path can be skipped, otherwise None
+        """
+        key = os.path.abspath(path)
+        self.seen.add(key)
+        row = self.lookup(key)
+        if row is None: return None
+        mtime0, size0, hash0, fingerprint0, action0, msg0 = row
+        if fingerprint0 != self.fingerprint_of(path): return None
+        try:
+            mtime, size = stat_stamp(os.stat(path))
+        except OSError:
+            return None
+        pass
+        if size != size0: return None
+        if mtime == mtime0: return action0, msg0
+        if hash0 is None or file_digest(path) != hash0: return None
+        self.execute("UPDATE files SET mtime = ? WHERE path = ?", (mtime, key))
+        self._pending()
+        return action0, msg0
+
+    def filter(self, paths, counts, msgs=None, stats=None):
+        """
+        :param paths: iterable of paths
+        :param counts: dict of action counts, incremented for cache hits
+        :param msgs: optional dict of msg counts, incremented for cache hits
+        :param stats: optional RunStats, the lookups are charged to its "cache" phase 
+                      excluding the time taken by the paths iterable, eg the walk
+        :return: generator of the paths that need processing
+        """
+        if stats is not None:
+            from runstats import timer, cpu
+        pass
+        for path in paths:
+            if stats is not None:
+                t0, c0 = timer(), cpu()
+            pass
+            hit = self.hit(path)
+            if stats is not None:
+                stats.charge("cache", t0, c0)
+            pass
+            if hit is None:
+                yield path
+            else:
+                action, msg = hit
+                self.hits += 1
+                counts[action] = counts.get(action, 0) + 1
+                if msgs is not None:
+                    msgs[msg] = msgs.get(msg, 0) + 1
+                pass
+            pass
+        pass
+
+    def record(self, r):
+        """
+        :param r: process_path result including the mtime, size and hash, which is None unless rewritten
+        """
+        key = os.path.abspath(r["path"])
+        if not r["action"] in self.actions or not "hash" in r:
+            self.execute("DELETE FROM files WHERE path = ?", (key,))
+        else:
+            action = "unchanged" if r["action"] == "rewritten" else r["action"]  # following the rewrite the header is current
+            msg = "has_license" if r["action"] == "rewritten" else r["msg"]
+            self.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)",
+                  (key, r["mtime"], r["size"], r["hash"], self.fingerprint_of(r["path"]), msg, action))
+        pass
+        self._pending()
+
+    def _pending(self):
+        with self.lock:
+            self.pending += 1
+            if self.pending >= self.commit_every:
+                self.conn.commit()
+                self.pending = 0
+            pass
+        pass
+
+    def commit(self):
+        with self.lock:
+            self.conn.commit()
+            self.pending = 0
+        pass
+
+    def forget(self, paths):
+        """
+        delete the rows of paths whose content was changed outside of a run, eg by a rollback
+        """
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(os.path.abspath(path),) for path in paths])
+        pass
+
+    def evict(self, roots):
+        """
+        delete rows for paths beneath the roots not encountered in this run that no longer exist
+
+        :param roots: directories walked in full, rows elsewhere are not checked
+        """
+        prefixes = tuple(os.path.join(os.path.abspath(root), "") for root in roots)
+        if len(prefixes) == 0: return 0
+        gone = [key for (key,) in self.execute("SELECT path FROM files") if key.startswith(prefixes) and not key in self.seen and not os.path.exists(key)]
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", [(key,) for key in gone])
+        pass
+        return len(gone)
+
+    def close(self, roots=()):
+        """
+        :param roots: directories walked in full by the run, whose rows for vanished paths are evicted. 
+                      Runs over git listed, sharded or explicit paths only see part of a tree so evict nothing.
+        """
+        nevict = self.evict(roots)
+        self.conn.commit()
+        self.conn.close()
+        log.debug("StatCache %s hits %d evicted %d " % (self.path, self.hits, nevict))
+
+    def __repr__(self):
+        return "StatCache %s %s " % (self.path, self.fingerprint[:8])
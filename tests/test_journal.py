@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+"""
+test_journal.py
+=================
+
+Regression tests of --transaction and --rollback::
+
+    python -m pytest -q tests
+    python -m unittest discover tests
+
+"""
+import os, sys, shutil, tempfile, logging, unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import licensehd, journal
+from licensehd import TMP_SUFFIX
+
+
+class JournalTest(unittest.TestCase):
+    nfile = 30
+    batch = 10
+
+    def setUp(self):
+        self.base = tempfile.mkdtemp()
+        self.tree = os.path.join(self.base, "tree")
+        self.cache = os.path.join(self.base, "licensehd.cache")
+        os.mkdir(self.tree)
+        self.orig = {}
+        for i in range(self.nfile):
+            path = os.path.join(self.tree, "f%d.c" % i)
+            with open(path, "w") as f:
+                f.write("int f%d;\n" % i)
+            pass
+            self.orig[path] = self.read(path)
+        pass
+        logging.disable(logging.CRITICAL)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+        shutil.rmtree(self.base)
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            return f.read()
+
+    def main(self, *argv):
+        return licensehd.main([self.tree, "--cache", self.cache, "--report", "none", "--fsync-batch", str(self.batch)] + list(argv))
+
+    def rewritten(self):
+        return sorted(path for path in self.orig if self.read(path) != self.orig[path])
+
+    def leftovers(self):
+        return [name for name in os.listdir(self.tree) if name.endswith(TMP_SUFFIX)]
+
+    def committed(self):
+        recs = journal.Journal(os.path.join(self.tree, journal.Journal.name)).records()
+        return sum(rec["n"] for rec in recs if rec["op"] == "commit")
+
+    def test_interrupted_commit(self):
+        """
+        Ctrl-C between the renames of a prepared batch completes the batch, so every
+        rewritten file is in a committed batch and rolling them all back restores the originals
+        """
+        replace = journal.replace
+        calls = [0]
+        def interrupting_replace(src, dst):
+            calls[0] += 1
+            if calls[0] == self.batch + 5:    # within the second batch
+                raise KeyboardInterrupt()
+            pass
+            return replace(src, dst)
+        journal.replace = interrupting_replace
+        try:
+            self.assertRaises(KeyboardInterrupt, self.main, "--transaction")
+        finally:
+            journal.replace = replace
+        pass
+        self.assertEqual(len(self.rewritten()), 2*self.batch)
+        self.assertEqual(len(self.rewritten()), self.committed())
+        self.assertEqual(self.leftovers(), [])
+        while self.main("--rollback") == 0:
+            pass
+        pass
+        self.assertEqual(self.rewritten(), [])
+
+    def test_interrupted_before_prepare(self):
+        """
+        Ctrl-C before the prepare of a batch leaves its originals untouched and no staged files
+        """
+        sync = getattr(os, "sync", None)
+        calls = [0]
+        def interrupting_sync():
+            calls[0] += 1
+            if calls[0] == 2:    # group sync of the second batch
+                raise KeyboardInterrupt()
+            pass
+        os.sync = interrupting_sync
+        try:
+            self.assertRaises(KeyboardInterrupt, self.main, "--transaction")
+        finally:
+            if sync is None:
+                del os.sync
+            else:
+                os.sync = sync
+            pass
+        pass
+        self.assertEqual(len(self.rewritten()), self.batch)
+        self.assertEqual(self.committed(), self.batch)
+        self.assertEqual(self.leftovers(), [])
+
+    def test_rollback_invalidates_cache(self):
+        """
+        After a rollback the cache no longer reports the restored files as up to date
+        """
+        self.assertEqual(self.main(), 0)
+        self.assertEqual(self.main("--check"), 0)
+        stamped = dict((path, self.read(path)) for path in self.orig)
+        self.assertEqual(self.main("--years", "2020-2020", "--transaction"), 0)
+        self.assertEqual(len(self.rewritten()), self.nfile)
+        for b in range(self.nfile//self.batch):
+            self.assertEqual(self.main("--rollback"), 0)
+        pass
+        self.assertEqual(self.main("--rollback"), 2)
+        self.assertEqual([path for path in self.orig if self.read(path) != stamped[path]], [])
+        self.assertEqual(self.main("--years", "2020-2020", "--check"), 1)
+        self.assertEqual(self.main("--years", "2020-2020", "--check", "--no-cache"), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,413 @@
+#!/usr/bin/env python
+"""
+watch.py
+==========
+
+Incremental mode of licensehd.py, following the initial sweep of the tree
+the process stays up with FileTypes and the rendered LicenseTmpl warm and
+only classifies and fixes files that appear or change::
+
+    licensehd.py ~/opticks --watch
+    licensehd.py ~/opticks --watch --check --debounce 2
+
+Changes are noticed with inotify where available, through ctypes on Linux,
+otherwise by polling: every --watch-interval seconds the mtime of each known
+directory is checked, rescanning only those that changed, which catches the
+creation, removal and renaming of files including the atomic rename
+of most editor saves. In place modifications do not change the directory
+mtime, so every full_every polls the files themselves are also stat-ed.
+
+The tree is tracked with a stat snapshot of path -> (mtime, size). A path is only
+processed once no further event has arrived for it for --debounce seconds, so a
+burst of saves triggers one rewrite, and only when its stat differs from the
+snapshot, which is updated following each rewrite so the events caused
+by our own writes are ignored.
+
+The snapshot is taken following the initial sweep, changes made in between are
+picked up by the next full poll, or the next modification.
+
+"""
+import os, sys, time, select, logging
+log = logging.getLogger(__name__)
+
+from licensehd import FT, PRUNE_DIRS, GitIgnore, is_excluded, process_path, scandir, CHECK_FAILS, CHECK_FMT
+from statcache import stat_stamp
+
+
+class Inotify(object):
+    """
+    Minimal ctypes binding of the Linux inotify API, watching directories
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM  = 0x00000040
+    IN_MOVED_TO    = 0x00000080
+    IN_CREATE      = 0x00000100
+    IN_DELETE      = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW  = 0x00004000
+    IN_IGNORED     = 0x00008000
+    IN_ISDIR       = 0x40000000
+    IN_NONBLOCK    = 0o4000
+    IN_CLOEXEC     = 0o2000000
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    @classmethod
+    def create(cls):
+        """
+        :return Inotify: or None when not available on the platform
+        """
+        if not sys.platform.startswith("linux"): return None
+        try:
+            import ctypes, ctypes.util
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            libc.inotify_init1
+        except (OSError, AttributeError, ImportError):
+            return None
+        pass
+        fd = libc.inotify_init1(cls.IN_NONBLOCK | cls.IN_CLOEXEC)
+        return None if fd < 0 else cls(libc, fd)
+
+    def __init__(self, libc, fd):
+        import struct
+        self.libc = libc
+        self.fd = fd
+        self.wds = {}
+        self.header = struct.Struct("iIII")
+
+    def add(self, fold):
+        """
+        :return ok: False when the watch could not be added, eg beyond fs.inotify.max_user_watches
+        """
+        name = os.fsencode(fold) if sys.version_info[0] > 2 else fold
+        wd = self.libc.inotify_add_watch(self.fd, name, self.mask)
+        if wd < 0:
+            import ctypes
+            log.warning("inotify_add_watch failed for %s : %s " % (fold, os.strerror(ctypes.get_errno())))
+            return False
+        pass
+        self.wds[wd] = fold
+        return True
+
+    def read(self, timeout):
+        """
+        :return events: list of (mask, path) waiting for at most timeout seconds,
+                        mask IN_Q_OVERFLOW with path None when events were lost
+        """
+        r, _, _ = select.select([self.fd], [], [], timeout)
+        if not r: return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except OSError:
+            return []
+        pass
+        events = []
+        i = 0
+        while i < len(buf):
+            wd, mask, cookie, n = self.header.unpack_from(buf, i)
+            name = buf[i+self.header.size:i+self.header.size+n].rstrip(b"\0")
+            i += self.header.size + n
+            if mask & self.IN_Q_OVERFLOW:
+                events.append((mask, None))
+                continue
+            pass
+            fold = self.wds.get(wd)
+            if fold is None: continue
+            if mask & self.IN_IGNORED:
+                del self.wds[wd]
+                continue
+            pass
+            name = os.fsdecode(name) if sys.version_info[0] > 2 else name
+            events.append((mask, os.path.join(fold, name) if name else fold))
+        pass
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+    full_every = 10     # polls between stat-ing every file in polling mode
+
+    def __init__(self, args):
+        self.args = args
+        self.files = {}       # path -> (mtime, size) snapshot
+        self.dirs = {}        # directory -> mtime
+        self.children = {}    # directory -> set of file paths
+        self.ignores = {}     # directory -> list of GitIgnore, None for excluded directories
+        self.pending = {}     # path -> time of the last event
+        self.npoll = 0
+        self.counts = {}
+        self.cache = None
+        if args.cache is not None:
+            from statcache import StatCache
+            from licensehd import LicenseHD
+            self.cache = StatCache(args.cache, StatCache.fingerprint(args, LicenseHD.headlines), args.configs)
+        pass
+        self.inotify = Inotify.create() if args.watch_mode != "poll" else None
+        if self.inotify is None and args.watch_mode == "inotify":
+            raise RuntimeError("inotify is not available")
+        pass
+        for root in args.paths:
+            self.add_dir(os.path.abspath(root), initial=True)
+        pass
+        log.info("watching %d directories %d files with %s " % (len(self.dirs), len(self.files), "inotify" if self.inotify else "polling"))
+
+    def ignores_of(self, fold):
+        """
+        :return ignores: GitIgnore of the directory and its ancestors up to the root,
+                         or None when the directory is pruned or excluded
+        """
+        if fold in self.ignores: return self.ignores[fold]
+        parent = os.path.dirname(fold)
+        name = os.path.basename(fold)
+        if not parent in self.ignores or parent == fold:
+            ignores = []      # a root
+        else:
+            ignores = self.ignores_of(parent)
+            if ignores is not None and (name in PRUNE_DIRS or is_excluded(fold, name, True, self.args.exclude, ignores)):
+                ignores = None
+            pass
+        pass
+        if ignores is not None and self.args.gitignore:
+            gi = GitIgnore.load(fold)
+            if gi is not None:
+                ignores = ignores + [gi]
+            pass
+        pass
+        self.ignores[fold] = ignores
+        return ignores
+
+    def is_candidate(self, path, ignores, st):
+        name = os.path.basename(path)
+        if FT.ftype_of(name) is None and not ("." not in name and st.st_mode & 0o111 and FT.sniff(path) is not None):
+            return False
+        pass
+        return not ((self.args.exclude or ignores) and is_excluded(path, name, False, self.args.exclude, ignores))
+
+    def add_dir(self, fold, initial=False):
+        """
+        Walk a directory new to the snapshot, with initial the files are recorded
+        as they are, otherwise they are all pending
+        """
+        ignores = self.ignores_of(fold)
+        if ignores is None: return
+        stack = [fold]
+        while stack:
+            fold = stack.pop()
+            try:
+                self.dirs[fold] = os.stat(fold).st_mtime
+            except OSError:
+                continue
+            pass
+            if self.inotify is not None and not self.inotify.add(fold):
+                log.warning("falling back to polling")
+                self.inotify.close()
+                self.inotify = None
+            pass
+            self.scan_dir(fold, initial, stack)
+        pass
+
+    def scan_dir(self, fold, initial=False, stack=None):
+        """
+        List a directory, new files and those differing from the snapshot become pending,
+        files no longer present are dropped and new subdirectories added
+        """
+        ignores = self.ignores_of(fold)
+        if ignores is None: return
+        try:
+            entries = list(scandir(fold))
+        except OSError:
+            self.drop_dir(fold)
+            return
+        pass
+        now = time.time()
+        present = set()
+        for e in entries:
+            path = os.path.join(fold, e.name)
+            try:
+                isdir = e.is_dir(follow_symlinks=False)
+                if not isdir:
+                    st = e.stat()
+                pass
+            except OSError:
+                continue
+            pass
+            if isdir:
+                if not path in self.dirs and self.ignores_of(path) is not None:
+                    if stack is not None:
+                        stack.append(path)
+                    else:
+                        self.add_dir(path)
+                    pass
+                pass
+            elif self.is_candidate(path, ignores, st):
+                present.add(path)
+                stamp = stat_stamp(st)
+                if initial:
+                    self.files[path] = stamp
+                elif self.files.get(path) != stamp:
+                    self.pending[path] = now
+                pass
+            pass
+        pass
+        for path in self.children.get(fold, set()) - present:
+            self.files.pop(path, None)
+            self.pending.pop(path, None)
+        pass
+        self.children[fold] = present
+
+    def drop_dir(self, fold):
+        for d in [d for d in self.dirs if d == fold or d.startswith(fold + os.sep)]:
+            for path in self.children.pop(d, set()):
+                self.files.pop(path, None)
+                self.pending.pop(path, None)
+            pass
+            self.dirs.pop(d, None)
+            self.ignores.pop(d, None)
+        pass
+
+    def poll(self):
+        """
+        Polling mode: rescan directories with changed mtime, every full_every polls also stat every file
+        """
+        self.npoll += 1
+        for fold in list(self.dirs):
+            if not fold in self.dirs: continue     # dropped along with a parent
+            try:
+                mtime = os.stat(fold).st_mtime
+            except OSError:
+                self.drop_dir(fold)
+                continue
+            pass
+            if mtime != self.dirs[fold]:
+                self.dirs[fold] = mtime
+                self.scan_dir(fold)
+            pass
+        pass
+        if self.npoll % self.full_every == 0:
+            now = time.time()
+            for path, stamp in list(self.files.items()):
+                try:
+                    if stat_stamp(os.stat(path)) != stamp:
+                        self.pending[path] = now
+                    pass
+                except OSError:
+                    pass
+                pass
+            pass
+        pass
+
+    def handle(self, events):
+        """
+        inotify mode: file events make the path pending, directory events rescan
+        """
+        now = time.time()
+        for mask, path in events:
+            if path is None:
+                log.warning("inotify queue overflow, rescanning ")
+                for fold in list(self.dirs):
+                    self.scan_dir(fold)
+                pass
+                continue
+            pass
+            if mask & Inotify.IN_DELETE_SELF:
+                self.drop_dir(path)
+            elif mask & Inotify.IN_ISDIR:
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    self.add_dir(path)
+                elif mask & Inotify.IN_MOVED_FROM:
+                    self.drop_dir(path)
+                pass
+            elif mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                self.files.pop(path, None)
+                self.pending.pop(path, None)
+            elif mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                fold = os.path.dirname(path)
+                ignores = self.ignores_of(fold) if fold in self.dirs else None
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                pass
+                if ignores is not None and self.is_candidate(path, ignores, st):
+                    self.children.setdefault(fold, set()).add(path)
+                    self.pending[path] = now
+                pass
+            pass
+        pass
+
+    def process(self):
+        """
+        Process the pending paths with no events for args.debounce seconds
+        """
+        now = time.time()
+        due = sorted(path for path, t in self.pending.items() if now - t >= self.args.debounce)
+        for path in due:
+            del self.pending[path]
+            try:
+                stamp = stat_stamp(os.stat(path))
+            except OSError:
+                continue
+            pass
+            if self.files.get(path) == stamp: continue     # eg the rename of our own rewrite
+            r = process_path(path, self.args)
+            self.counts[r["action"]] = self.counts.get(r["action"], 0) + 1
+            if r["action"] in CHECK_FAILS or r["action"] == "failed":
+                print(CHECK_FMT % r)
+            elif r["action"] != "unchanged":
+                log.info("%-10s %s " % (r["action"], path))
+            pass
+            if self.cache is not None:
+                self.cache.record(r)
+            pass
+            try:
+                self.files[path] = stat_stamp(os.stat(path))
+            except OSError:
+                self.files.pop(path, None)
+            pass
+        pass
+        if len(due) > 0 and self.cache is not None:
+            self.cache.commit()
+        pass
+
+    def timeout(self):
+        """
+        :return seconds: until the next pending path is due, or the poll interval
+        """
+        t = self.args.watch_interval
+        if self.pending:
+            t = min(t, max(0., min(self.pending.values()) + self.args.debounce - time.time()))
+        pass
+        return t
+
+    def loop(self):
+        """
+        :return rc: on interrupt or SIGTERM, non-zero when any file processed was missing, stale or failed
+        """
+        from licensehd import summary
+        import signal
+        def terminate(signum, frame):
+            raise KeyboardInterrupt()
+        signal.signal(signal.SIGTERM, terminate)    # stop cleanly under service managers too 
+        try:
+            while True:
+                if self.inotify is not None:
+                    self.handle(self.inotify.read(self.timeout()))
+                else:
+                    time.sleep(self.timeout())
+                    self.poll()
+                pass
+                self.process()
+            pass
+        except KeyboardInterrupt:
+            log.info("watch interrupted ")
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+            pass
+            if self.cache is not None:
+                self.cache.close()
+            pass
+            log.info("watch %s " % summary(self.counts))
+        pass
+        return 1 if any(self.counts.get(action, 0) > 0 for action in CHECK_FAILS + ["failed"]) else 0